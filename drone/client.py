@@ -49,6 +49,7 @@ lib_dir = os.path.realpath(os.path.join(current_dir, '../lib'))
 sys.path.insert(0, lib_dir)
 
 import messaging
+import git_version
 import modules.client_core as client_core
 import modules.animation as animation
 import modules.mavros_wrapper as mavros
@@ -465,19 +466,19 @@ def _response_position(*args, **kwargs):
         telem.x, telem.y, telem.z, math.degrees(telem.yaw), copter.config.flight_frame_id)
 
 
-@messaging.request_callback("calibrate_gyro")
+@messaging.request_callback("calibrate_gyro", pooled=True)
 def _calibrate_gyro(*args, **kwargs):
     mavros.calibrate('gyro')
     return mavros.get_calibration_status()
 
 
-@messaging.request_callback("calibrate_level")
+@messaging.request_callback("calibrate_level", pooled=True)
 def _calibrate_level(*args, **kwargs):
     mavros.calibrate('level')
     return mavros.get_calibration_status()
 
 
-@messaging.request_callback("load_params")
+@messaging.request_callback("load_params", pooled=True)
 def _load_params(*args, **kwargs):
     result = mavros.load_param_file('temp.params')
     logger.info("Load parameters to FCU success: {}".format(result))
@@ -542,7 +543,7 @@ def _command_reset_z(*args, **kwargs):
     logger.info("Reset z offset to {:.2f}".format(copter.config.animation_private_offset[2]))
 
 
-@messaging.message_callback("update_repo")
+@messaging.message_callback("update_repo", pooled=True)
 def _command_update_repo(*args, **kwargs):
     os.system("git fetch")
     os.system("git pull --rebase")
@@ -575,6 +576,11 @@ def _command_chrony_repair(*args, **kwargs):
     repair_chrony(copter.config.server_host)
 
 
+@messaging.message_callback("telemetry_resync")
+def _command_telemetry_resync(*args, **kwargs):
+    copter.telemetry.request_keyframe()
+
+
 @messaging.message_callback("led_test")
 def _command_led_test(*args, **kwargs):
     led.set_effect(effect='flash', r=255, g=255, b=255)
@@ -677,26 +683,37 @@ def _command_resume(*args, **kwargs):
 
 @messaging.message_callback("start")
 def _play_animation(*args, **kwargs):
+    start_id = kwargs.get("start_id", None)
+
+    def acknowledge(tasks=0, first_frame=None, error=None):
+        # servers tracking fleet start wait for every copter to confirm it is armed
+        if start_id is not None:
+            copter.server_connection.send_message("start_ack", kwargs={"start_id": start_id, "tasks": tasks,
+                                                                       "first_frame": first_frame, "error": error})
 
     # Validate start_time
     try:
         start_time = float(kwargs["time"])
     except ValueError:
         logger.error("start: Wrong time argument!")
+        acknowledge(error="Wrong time argument")
         return
     except KeyError:
         logger.error("start: No time argument!")
+        acknowledge(error="No time argument")
         return
 
     # Check animation state
     if copter.animation.state is not "OK":
         logger.error("start: Bad animation state")
+        acknowledge(error="Bad animation state")
         return
 
     # Get output frames
     frames = copter.animation.get_output_frames(copter.telemetry.start_action)
     if not frames:
         logger.error("start: No frames in animation!")
+        acknowledge(error="No frames in animation")
         return
 
     # Get current telemetry
@@ -715,6 +732,7 @@ def _play_animation(*args, **kwargs):
                               })
         frame_time += frame.delay
     task_manager.add_task(frame_time, 0, animation.turn_off_led)
+    acknowledge(tasks=len(frames) + 1, first_frame=start_time)
 
 # noinspection PyAttributeOutsideInit
 class Telemetry:
@@ -731,6 +749,7 @@ class Telemetry:
         "start_position": None,
         "last_task": None,
         "time_delta": None,
+        "clock_sync": None,
         "config_version": None,
     }
 
@@ -743,6 +762,11 @@ class Telemetry:
         self.ros_telemetry = None
         self.start_action = None
 
+        # delta encoding of transmitted telemetry
+        self._transmit_seq = 0
+        self._transmitted = {}
+        self._keyframe_required = True
+
         for key, value in self.params_default_dict.items():
             setattr(self, key, value)
 
@@ -762,12 +786,18 @@ class Telemetry:
 
     @classmethod
     def get_git_version(cls):
-        return subprocess.check_output("git log --pretty=format:'%h' -n 1", shell=True)
+        return git_version.get_git_version()
 
     @classmethod
     def get_config_version(cls):
         return "{} V{}".format(copter.config.config_name, copter.config.config_version)
 
+    @classmethod
+    def get_clock_sync(cls):
+        # offset, uncertainty and age of last sync in seconds
+        status = copter.clock.status() if copter.clock is not None else None
+        return [round(v, 4) for v in status] if status is not None else None
+
     def get_start_position(self):
         try:
             x, y, z = copter.animation.get_start_frame('fly').get_pos()
@@ -851,6 +881,7 @@ class Telemetry:
         self.git_version = self.get_git_version()
         self.config_version = self.get_config_version()
         self.start_position = self.get_start_position()
+        self.clock_sync = self.get_clock_sync()
         try:
             self.calibration_status = mavros.get_calibration_status()
             self.fcu_status = mavros.get_sys_status()
@@ -915,11 +946,32 @@ class Telemetry:
             self._tasks_cleared = False
         self._last_state = state
 
+    def request_keyframe(self):
+        self._keyframe_required = True
+
+    def create_delta_contents(self, keyframe_interval):
+        """Return telemetry values changed since previous call and whether it's full keyframe."""
+        contents = self.create_msg_contents()
+        keyframe = (self._keyframe_required or not keyframe_interval or
+                    self._transmit_seq % keyframe_interval == 0)
+        if not keyframe:
+            # repr comparison treats nan values as equal
+            contents = {key: value for key, value in contents.items()
+                        if key not in self._transmitted or repr(self._transmitted[key]) != repr(value)}
+        self._transmitted.update(contents)
+        self._keyframe_required = False
+        return contents, keyframe
+
     def transmit_message(self):  # todo if connected
+        contents, keyframe = self.create_delta_contents(copter.config.telemetry_keyframe_interval)
         try:
-            copter.server_connection.send_message('telemetry', kwargs={'value': self.create_msg_contents()})
+            copter.server_connection.send_message('telemetry', kwargs={'value': contents,
+                                                                       'seq': self._transmit_seq,
+                                                                       'keyframe': keyframe},
+                                                  priority=messaging.PRIORITY_NORMAL, droppable=True)
         except AttributeError as e:
             logger.debug(e)
+        self._transmit_seq += 1
 
     @classmethod
     def log_cpu_and_memory(cls):
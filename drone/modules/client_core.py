@@ -6,6 +6,8 @@ import random
 import socket
 import struct
 import logging
+import threading
+import collections
 import selectors2 as selectors
 
 from contextlib import closing
@@ -18,6 +20,7 @@ sys.path.insert(0, lib_dir)
 logger = logging.getLogger(__name__)
 
 import messaging
+from clock_sync import ClockSync
 from config import ConfigManager
 
 active_client = None  # needs to be refactored: Singleton \ factory callbacks
@@ -26,12 +29,18 @@ active_client = None  # needs to be refactored: Singleton \ factory callbacks
 class Client(object):
     def __init__(self, config_path="config/client.ini"):
         self.selector = selectors.DefaultSelector()
+        self.waker = messaging.SelectorWaker(self.selector)
         self.client_socket = None
 
         self.server_connection = messaging.ConnectionManager()
 
         self.connected = False
         self.client_id = None
+        self.clock = None  # synchronized with NTP server if enabled
+
+        # UDP command channel
+        self._commands_seen = collections.OrderedDict()  # (server_id, seq) of recently processed commands
+        self._commands_lock = threading.Lock()
 
         # Init configs
         self.config = ConfigManager()
@@ -56,30 +65,30 @@ class Client(object):
 
         logger.info("Config loaded")
 
-    @staticmethod
-    def get_ntp_time(ntp_host, ntp_port):
-        NTP_PACKET_FORMAT = "!12I"
-        NTP_DELTA = 2208988800L  # 1970-01-01 00:00:00
-        NTP_QUERY = '\x1b' + 47 * '\0'
-
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
-            s.sendto(bytes(NTP_QUERY), (ntp_host, ntp_port))
-            msg, address = s.recvfrom(1024)
-        unpacked = struct.unpack(NTP_PACKET_FORMAT, msg[0:struct.calcsize(NTP_PACKET_FORMAT)])
-        return unpacked[10] + float(unpacked[11]) / 2 ** 32 - NTP_DELTA
-
     def time_now(self):
-        if self.config.ntp_use:
-            timenow = self.get_ntp_time(self.config.ntp_host, self.config.ntp_port)
-        else:
-            timenow = time.time()
-        return timenow
+        if self.clock is not None:
+            return self.clock.time_now()
+        return time.time()
 
     def start(self):
         self.load_config()
 
         logger.info("Starting client")
-        messaging.NotifierSock().init(self.selector)
+
+        if self.config.ntp_use:
+            self.clock = ClockSync(self.config.ntp_host, self.config.ntp_port, self.config.ntp_interval,
+                                   self.config.ntp_burst)
+            self.clock.start()
+
+        if self.config.broadcast_commands:
+            command_sock = self._bind_command_socket()
+            if command_sock is not None:
+                # server sends commands over UDP only to copters announcing they listen
+                self.server_connection.extra_capabilities["udp_commands"] = True
+                command_thread = threading.Thread(target=self._command_listen, args=(command_sock, ),
+                                                  name="UDP command listener")
+                command_thread.daemon = True
+                command_thread.start()
 
         try:
             while True:
@@ -124,6 +133,17 @@ class Client(object):
     def _connect(self):
         self.connected = True
         self.client_socket.setblocking(False)
+        self.server_connection.buffer_size = self.config.server_buffer_size
+        self.server_connection.socket_sndbuf = self.config.server_socket_sndbuf
+        self.server_connection.socket_rcvbuf = self.config.server_socket_rcvbuf
+        self.server_connection.binary_header = self.config.server_binary_header
+        self.server_connection.compression_threshold = self.config.server_compression_threshold
+        self.server_connection.compression_level = self.config.server_compression_level
+        self.server_connection.send_queue_messages = self.config.server_send_queue_messages
+        self.server_connection.send_queue_bytes = self.config.server_send_queue_bytes
+        self.server_connection.queue_policies[messaging.PRIORITY_NORMAL] = \
+            self.config.server_send_queue_normal_policy
+        self.server_connection.session_id = self.client_id  # server finds this copter's session by id
         self.selector.register(self.client_socket, selectors.EVENT_READ, data=self.server_connection)
         self.server_connection.connect(self.selector, self.client_socket,
                                        (self.config.server_host, self.config.server_port))
@@ -168,6 +188,70 @@ class Client(object):
     def on_broadcast_bind(self):  # TODO move ALL binding code here
         pass
 
+    def _bind_command_socket(self):
+        command_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        command_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            command_sock.bind(("", self.config.broadcast_command_port))
+            if self.config.broadcast_command_group:
+                membership = struct.pack("4s4s", socket.inet_aton(self.config.broadcast_command_group),
+                                         socket.inet_aton("0.0.0.0"))
+                command_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except socket.error as error:
+            logger.error("Error during command listening binding: {}".format(error))
+            command_sock.close()
+            return None
+        return command_sock
+
+    def _command_listen(self, command_sock):
+        logger.info("Listening for UDP commands on port {}".format(self.config.broadcast_command_port))
+        with closing(command_sock):
+            while True:
+                try:
+                    data, addr = command_sock.recvfrom(65536)
+                except socket.error as error:
+                    logger.warning("Could not receive command due error: {}".format(error))
+                    continue
+
+                if not self.connected or addr[0] != self.config.server_host:
+                    continue  # commands are accepted only from connected server
+                try:
+                    self._process_command_datagram(data, addr)
+                except Exception as error:  # listener must survive any malformed datagram
+                    logger.warning("Got malformed command from {}: {!r}".format(addr, error))
+
+    def _process_command_datagram(self, data, addr):
+        message = messaging.MessageManager()
+        message.process_message(messaging.ReceiveBuffer.from_bytes(data))
+        if message.content is None or message.jsonheader.get("action") != "command":
+            logger.warning("Got wrong command message from {}".format(addr))
+            return
+        self.process_command(message.content["kwargs"], "udp")
+
+    def process_command(self, command, via):
+        """Execute command received over UDP or TCP once and acknowledge it over TCP."""
+        received = time.time()  # converted to server time by server with clock offset estimated by pings
+        targets = command["targets"]
+        if targets is not None and self.client_id not in targets:
+            return False
+
+        key = (command["server_id"], command["seq"])
+        with self._commands_lock:
+            if key in self._commands_seen:
+                return False
+            self._commands_seen[key] = received
+            if len(self._commands_seen) > 256:
+                self._commands_seen.popitem(last=False)
+
+        logger.info("Command {} #{} received over {}".format(command["action"], command["seq"], via))
+        self.server_connection.send_message("command_ack", kwargs={"seq": command["seq"], "received": received,
+                                                                   "via": via})
+        kwargs = command["kwargs"]
+        target_kwargs = command.get("target_kwargs", {}).get(self.client_id, None)
+        if target_kwargs:
+            kwargs = dict(kwargs, **target_kwargs)
+        return self.server_connection.run_action(command["action"], command["args"], kwargs)
+
     def _process_connections(self):
         while True:
             events = self.selector.select(timeout=1)
@@ -187,9 +271,11 @@ class Client(object):
                         if isinstance(error, OSError):
                             if error.errno == errno.EINTR:
                                 raise KeyboardInterrupt
+
+            self.server_connection.expire_requests()
             try:
                 mapping_fds = self.selector.get_map().keys() # file descriptors
-                notifier_fd = messaging.NotifierSock().get_sock().fileno()
+                notifier_fd = self.waker.fileno()
             except (KeyError, RuntimeError) as e:
                 logger.error("Exception {} occurred when getting connections map!".format(e))
                 logger.error("Connections changed during getting connections map, passing")
@@ -215,6 +301,11 @@ def _command_config_write(*args, **kwargs):
     logger.info("Config successfully updated from command")
     active_client.load_config()
 
+@messaging.message_callback("command")
+def _command(*args, **kwargs):
+    active_client.process_command(kwargs, "tcp")
+
+
 @messaging.request_callback("config")
 def _response_config(*args, **kwargs):
     send_configspec = kwargs.get("send_configspec", False)
@@ -227,6 +318,10 @@ def _response_config(*args, **kwargs):
 def _response_clover_dir(*args, **kwargs):
     return active_client.config.clover_dir
 
+@messaging.request_callback("file_hash", pooled=True)
+def _response_file_hash(*args, **kwargs):
+    return {filepath: messaging.file_hash(filepath) for filepath in kwargs.get("filepaths", ())}
+
 @messaging.request_callback("id")
 def _response_id(*args, **kwargs):
     new_id = kwargs.get("new_id", None)
@@ -243,6 +338,13 @@ def _response_time(*args, **kwargs):
     return active_client.time_now()
 
 
+@messaging.request_callback("ping")
+def _response_ping(*args, **kwargs):
+    # offset to the clock tasks are scheduled by, so start times converted by server need no correction here
+    received = time.time()
+    return [received, time.time()]
+
+
 if __name__ == "__main__":
     startup_cwd = os.getcwd()
 
@@ -264,7 +366,9 @@ if __name__ == "__main__":
             #t = dict([('fcu_status', None), ('current_position', [-2.89, 2.12, 3.64, 15.22, 'aruco_map']), ('animation_id', 'two_drones_test'), ('selfcheck', 'OK'), ('battery', None), ('git_version', '01bf95e'), ('calibration_status', None), ('start_position', [0.2, 0.2, 0.0]), ('mode', 'MANUAL'), ('time_delta', 1581338473.438682), ('armed', False), ('config_version', None), ('last_task', 'No task')])
             t = dict([('fcu_status', 'STANDBY'), ('current_position', [-1.17, 2.04, 3.45, 0, "11"]), ('animation_id', 'two_drones_test'), ('selfcheck', 'OK'), ('battery', [12.2, 1.0]), ('git_version', '42aee96'), ('calibration_status', None), ('start_position', [0.2, 0.2, 0.0]), ('mode', 'MANUAL'), ('time_delta', 1581342970.889573), ('armed', False), ('config_version', 'Copter config V0.0'), ('last_task', 'No task')])
             if active_client.connected:
-                active_client.server_connection.send_message("telemetry", kwargs={"value": t})
+                active_client.server_connection.send_message("telemetry", kwargs={"value": t},
+                                                              priority=messaging.PRIORITY_NORMAL,
+                                                              droppable=True)
 
     logging.basicConfig(level=logging.DEBUG)
     client = Client()
@@ -0,0 +1,80 @@
+import os
+import sys
+import socket
+
+import pytest
+
+# Add parent dir to PATH to import clock_sync
+current_dir = (os.path.dirname(os.path.realpath(__file__)))
+root_dir = os.path.realpath(os.path.join(current_dir, '../..'))
+lib_dir = os.path.realpath(os.path.join(root_dir, 'lib'))
+sys.path.insert(0, lib_dir)
+
+import clock_sync
+
+
+def test_sync_selects_fastest_sample():
+    samples = [(0.5, 0.2), (0.1, 0.01), (-0.3, 0.1)]
+    queries = []
+
+    def query(host, port, timeout):
+        queries.append((host, port))
+        return samples[len(queries) - 1]
+
+    clock = clock_sync.ClockSync("ntp.test", 1123, burst=3, query=query)
+    assert not clock.synced
+    assert clock.status() is None
+    assert clock.sync()
+
+    assert queries == [("ntp.test", 1123)] * 3
+    offset, uncertainty, age = clock.status()
+    assert offset == pytest.approx(0.1)
+    assert uncertainty == pytest.approx(0.005, abs=1e-4)
+    assert age < 1.0
+
+
+def test_sync_without_response():
+    def query(host, port, timeout):
+        raise socket.timeout("timed out")
+
+    clock = clock_sync.ClockSync("ntp.test", burst=2, query=query)
+    assert not clock.sync()
+    assert not clock.synced
+    assert clock.offset() == 0.0
+
+
+def test_drift_estimate():
+    clock = clock_sync.ClockSync("ntp.test", smoothing=1.0)
+    # local clock loses 100 us each second
+    for t in range(0, 640, 64):
+        clock.add_sample(0.2 + 100e-6 * t, 0.002, now=1000.0 + t)
+
+    assert clock.offset(now=1000.0 + 576) == pytest.approx(0.2 + 100e-6 * 576)
+    assert clock.offset(now=1000.0 + 640) == pytest.approx(0.2 + 100e-6 * 640)
+
+
+def test_drift_is_limited():
+    clock = clock_sync.ClockSync("ntp.test", smoothing=1.0)
+    clock.add_sample(0.0, 0.002, now=1000.0)
+    clock.add_sample(1.0, 0.002, now=1001.0)  # step of the server clock, not drift
+
+    assert clock.offset(now=1001.0) == pytest.approx(1.0)
+    assert clock.offset(now=1002.0) == pytest.approx(1.0 + clock_sync.MAX_DRIFT)
+
+
+def test_exchange_filter():
+    exchanges = clock_sync.ExchangeFilter(window=3)
+    # remote clock is 2 s ahead, request takes 10 ms and response 30 ms to travel, 5 ms of remote processing
+    assert exchanges.add(100.0, 102.01, 102.015, 100.045) == (pytest.approx(1.99), pytest.approx(0.04))
+    assert exchanges.offset == pytest.approx(1.99)
+    assert exchanges.delay == pytest.approx(0.02)
+
+    exchanges.add(101.0, 103.005, 103.006, 101.011)  # symmetric fast exchange
+    exchanges.add(102.0, 104.1, 104.1, 102.2)  # queued
+    assert exchanges.offset == pytest.approx(2.0)
+    assert exchanges.delay == pytest.approx(0.02)
+
+    exchanges.add(103.0, 105.1, 105.1, 103.2)  # fast exchange left the window
+    exchanges.add(104.0, 106.1, 106.1, 104.2)
+    assert exchanges.offset == pytest.approx(2.0)
+    assert exchanges.delay == pytest.approx(0.1)
@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import pytest
+
+# Add parent dir to PATH to import git_version
+current_dir = (os.path.dirname(os.path.realpath(__file__)))
+root_dir = os.path.realpath(os.path.join(current_dir, '../..'))
+lib_dir = os.path.realpath(os.path.join(root_dir, 'lib'))
+sys.path.insert(0, lib_dir)
+
+import git_version
+
+FIRST = "42aee961c0d7f1b2a2e7fd3a3a1f6c3c9e8b7a61"
+SECOND = "11318ca0be3e3de7a0a83f7cba9b3e6ad8e2f5c4"
+
+
+@pytest.fixture
+def repository():
+    path = tempfile.mkdtemp()
+    os.makedirs(os.path.join(path, ".git", "refs", "heads"))
+    os.makedirs(os.path.join(path, "drone", "modules"))
+    yield path
+    shutil.rmtree(path)
+
+
+def write(path, *names, **kwargs):
+    with open(os.path.join(path, *names), 'w') as f:
+        f.write(kwargs["content"])
+
+
+def test_find_git_dir(repository):
+    assert git_version.find_git_dir(os.path.join(repository, "drone", "modules")) == \
+        os.path.join(repository, ".git")
+
+    worktree = tempfile.mkdtemp()
+    try:
+        write(worktree, ".git", content="gitdir: {}\n".format(os.path.join(repository, ".git")))
+        assert git_version.find_git_dir(worktree) == os.path.join(repository, ".git")
+    finally:
+        shutil.rmtree(worktree)
+
+
+def test_version_of_branch(repository):
+    write(repository, ".git", "HEAD", content="ref: refs/heads/master\n")
+    write(repository, ".git", "refs", "heads", "master", content=FIRST + "\n")
+    version = git_version.GitVersion(os.path.join(repository, "drone"), check_interval=0)
+    assert version.version == "42aee96"
+
+    time.sleep(0.01)
+    write(repository, ".git", "refs", "heads", "master", content=SECOND + "\n")
+    assert version.version == "11318ca"
+
+
+def test_version_is_cached(repository):
+    write(repository, ".git", "HEAD", content=FIRST + "\n")  # detached HEAD
+    version = git_version.GitVersion(repository, check_interval=60)
+    assert version.version == "42aee96"
+
+    write(repository, ".git", "HEAD", content=SECOND + "\n")
+    assert version.version == "42aee96"
+
+
+def test_packed_refs(repository):
+    write(repository, ".git", "HEAD", content="ref: refs/heads/master\n")
+    write(repository, ".git", "packed-refs", content="# pack-refs with: peeled fully-peeled sorted\n"
+                                                     "{} refs/heads/develop\n{} refs/heads/master\n"
+                                                     "^{}\n".format(SECOND, FIRST, SECOND))
+    assert git_version.GitVersion(repository).version == "42aee96"
+
+
+def test_worktree(repository):
+    git_dir = os.path.join(repository, ".git", "worktrees", "feature")
+    os.makedirs(git_dir)
+    write(git_dir, "HEAD", content="ref: refs/heads/feature\n")
+    write(git_dir, "commondir", content="../..\n")
+    write(repository, ".git", "HEAD", content="ref: refs/heads/master\n")
+    write(repository, ".git", "refs", "heads", "master", content=FIRST + "\n")
+    write(repository, ".git", "refs", "heads", "feature", content=SECOND + "\n")
+
+    worktree = tempfile.mkdtemp()
+    try:
+        write(worktree, ".git", content="gitdir: {}\n".format(git_dir))
+        assert git_version.GitVersion(worktree).version == "11318ca"
+    finally:
+        shutil.rmtree(worktree)
+
+
+def test_no_repository(repository):
+    assert git_version.GitVersion(repository).version is None  # HEAD is missing
+    shutil.rmtree(os.path.join(repository, ".git"))
+    assert git_version.GitVersion(repository).version is None
@@ -0,0 +1,574 @@
+import os
+import sys
+import time
+import socket
+import shutil
+import hashlib
+import tempfile
+import threading
+
+import pytest
+
+# Add parent dir to PATH to import messaging_lib and config_lib
+current_dir = (os.path.dirname(os.path.realpath(__file__)))
+root_dir = os.path.realpath(os.path.join(current_dir, '../..'))
+lib_dir = os.path.realpath(os.path.join(root_dir, 'lib'))
+sys.path.insert(0, lib_dir)
+
+import messaging
+from messaging import selectors
+
+
+class ReceivingConnection(messaging.ConnectionManager):
+    def __init__(self, sock):
+        super(ReceivingConnection, self).__init__()
+        self.socket = sock
+        self.received = []
+
+    def process_received(self, message):
+        self.received.append(message)
+
+
+def feed(connection, sock, data, chunk_size):
+    for i in range(0, len(data), chunk_size):
+        sock.sendall(data[i:i + chunk_size])
+        connection.read()
+
+
+def connected_pair():
+    selector = selectors.DefaultSelector()
+    connections = []
+    for sock in socket.socketpair():
+        sock.setblocking(False)
+        connection = messaging.ConnectionManager()
+        selector.register(sock, selectors.EVENT_READ, data=connection)
+        connection.connect(selector, sock, sock.getsockname())
+        connections.append(connection)
+    return selector, connections
+
+
+def pump(selector, condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        for key, mask in selector.select(timeout=0.05):
+            key.data.process_events(mask)
+    return condition()
+
+
+def test_receive_buffer():
+    buffer = messaging.ReceiveBuffer(4)
+    buffer.extend(b"abcdef")
+    assert len(buffer) == 6
+    assert buffer.consume(2).tobytes() == b"ab"
+    buffer.extend(b"gh")
+    assert buffer.peek(3).tobytes() == b"cde"
+    assert buffer.read_all() == b"cdefgh"
+    assert len(buffer) == 0
+
+
+def test_legacy_income_raw():
+    message = messaging.MessageManager()
+    message.income_raw = messaging.MessageManager.create_action_message("server_ip", kwargs={"id": "1"}) + b"tail"
+    message.process_message()
+    assert message.jsonheader["action"] == "server_ip"
+    assert message.content["kwargs"]["id"] == "1"
+    assert message.income_raw == b"tail"
+
+
+def test_binary_header():
+    message = messaging.MessageManager()
+    message.income_raw = messaging.MessageManager.create_response("telemetry", "42", {"mode": "MANUAL"},
+                                                                  binary_header=True)
+    assert len(message.income_raw) < len(messaging.MessageManager.create_response("telemetry", "42",
+                                                                                  {"mode": "MANUAL"}))
+    message.process_message()
+    assert message.jsonheader["message-type"] == "response"
+    assert message.jsonheader["requested_value"] == "telemetry"
+    assert message.jsonheader["request_id"] == "42"
+    assert message.content["value"]["mode"] == "MANUAL"
+
+    # headers that do not fit into binary header fall back to JSON
+    data = messaging.MessageManager.create_message(b"", "binary", "message", binary_header=True,
+                                                   additional_headers={"action": "filechunk", "offset": 0})
+    assert data[:2] != b"\xff\xff"
+
+
+def test_compression():
+    compression = messaging.Compression(threshold=1024, level=6)
+    value = {"animation": "frame 0 0 1\n" * 1000}
+    for binary_header in (False, True):
+        data = messaging.MessageManager.create_response("animation", "7", value, binary_header=binary_header,
+                                                        compression=compression)
+        assert len(data) < len(messaging.MessageManager._json_encode({"value": value})) // 10
+        message = messaging.MessageManager()
+        message.process_message(messaging.ReceiveBuffer.from_bytes(data))
+        assert message.jsonheader["content-compression"] == "zlib"
+        assert message.content["value"] == value
+
+    # small and incompressible messages are sent as is
+    for content in (b"small", os.urandom(4096)):
+        data = messaging.MessageManager.create_message(content, "binary", "message", compression=compression,
+                                                       additional_headers={"action": "a"})
+        message = messaging.MessageManager()
+        message.process_message(messaging.ReceiveBuffer.from_bytes(data))
+        assert "content-compression" not in message.jsonheader
+        assert message.content == content
+
+
+def test_fragmented_receive():
+    sending, receiving = socket.socketpair()
+    connection = ReceivingConnection(receiving)
+    payload = os.urandom(70000)
+    data = messaging.MessageManager.create_json_message({"value": 1}) + \
+        messaging.MessageManager.create_message(payload, "binary", "message", additional_headers={"action": "a"}) + \
+        messaging.MessageManager.create_json_message({"value": 2})
+    try:
+        feed(connection, sending, data, 1000)
+    finally:
+        sending.close()
+        receiving.close()
+
+    assert [m.jsonheader["content-type"] for m in connection.received] == ["json", "binary", "json"]
+    assert connection.received[0].content["value"] == 1
+    assert connection.received[1].content == payload
+    assert connection.received[2].content["value"] == 2
+
+
+def test_capabilities_negotiation():
+    selector, (first, second) = connected_pair()
+    received = []
+    messaging.ConnectionManager.messages_callbacks["test"] = lambda connection, **kwargs: received.append(kwargs)
+    try:
+        assert pump(selector, lambda: first.use_binary_header and second.use_binary_header)
+        assert "session_id" not in second.peer_capabilities
+        first.session_id = "copter1"
+        assert first.capabilities()["session_id"] == "copter1"
+        assert first.message_options["compression"] == messaging.Compression(4096, 6)
+        first.send_message("test", kwargs={"value": 1})
+        assert pump(selector, lambda: received)
+        assert received == [{"value": 1}]
+    finally:
+        messaging.ConnectionManager.messages_callbacks.pop("test")
+        for connection in (first, second):
+            connection.socket.close()
+        selector.close()
+
+
+def test_selector_waker():
+    selector = selectors.DefaultSelector()
+    waker = messaging.SelectorWaker(selector)
+    try:
+        assert messaging.SelectorWaker.get(selector) is waker
+        assert not selector.select(timeout=0)
+        for _ in range(100):
+            waker.notify()
+        assert waker._receiving_sock.recv(1024, socket.MSG_PEEK) == b"\0"  # wakeups are coalesced
+        for key, mask in selector.select(timeout=1):
+            key.data.process_events(mask)
+        assert not selector.select(timeout=0)
+
+        waker.notify()
+        assert [key.data for key, mask in selector.select(timeout=1)] == [waker]
+    finally:
+        waker.close()
+        selector.close()
+    assert messaging.SelectorWaker.get(selector) is None
+
+
+def test_coalesced_write():
+    selector, (sender, receiver) = connected_pair()
+    received = []
+    messaging.ConnectionManager.messages_callbacks["test"] = lambda connection, **kwargs: received.append(kwargs)
+    try:
+        assert pump(selector, lambda: sender.use_binary_header and not sender._writing)
+        mask_changes = []
+        set_mask = sender._set_selector_events_mask
+        sender._set_selector_events_mask = lambda mode: mask_changes.append(mode) or set_mask(mode)
+
+        for i in range(200):
+            sender.send_message("test", kwargs={"value": i})
+        assert mask_changes == ['rw']
+        sender.write()  # single write sends all queued messages
+        assert not any(sender._send_queues) and not sender._send_buffers
+        assert mask_changes == ['rw', 'r']
+
+        assert pump(selector, lambda: len(received) == 200)
+        assert [kwargs["value"] for kwargs in received] == list(range(200))
+    finally:
+        messaging.ConnectionManager.messages_callbacks.pop("test")
+        for connection in (sender, receiver):
+            connection.socket.close()
+        selector.close()
+
+
+def test_request_timeout():
+    selector, (server, client) = connected_pair()
+    responses, timeouts = [], []
+    messaging.ConnectionManager.requests_callbacks["slow"] = lambda connection, delay=0: delay
+    try:
+        on_response = lambda connection, value, **kwargs: responses.append(value)
+        on_timeout = lambda connection, **kwargs: timeouts.append(kwargs["n"])
+        for n in range(3):
+            server.get_response("slow", on_response, callback_kwargs={"n": n}, timeout=n,
+                                timeout_callback=on_timeout)
+        request_ids = list(server._request_queue.keys())
+        assert request_ids == sorted(request_ids, key=int) and len(set(request_ids)) == 3
+        assert server.requests_outstanding == 3
+
+        # request 0 has no timeout; request 1 expires before request 2
+        assert server.expire_requests(messaging.monotonic() + 1.5) == 1
+        assert timeouts == [1] and server.requests_outstanding == 2
+        assert pump(selector, lambda: len(responses) == 2)
+        assert server.requests_outstanding == 0
+        assert server.expire_requests(messaging.monotonic() + 10) == 0
+        assert server.requests_expired == 1 and timeouts == [1]
+    finally:
+        messaging.ConnectionManager.requests_callbacks.pop("slow")
+        for connection in (server, client):
+            connection.socket.close()
+        selector.close()
+
+
+@pytest.mark.skipif(messaging.futures is None, reason="concurrent.futures is not available")
+def test_request_futures():
+    selector, (server, client) = connected_pair()
+    second_selector, (second_server, second_client) = connected_pair()
+    messaging.ConnectionManager.requests_callbacks["echo"] = lambda connection, value=None: value
+    try:
+        future = server.request("echo", request_kwargs={"value": 42}, timeout=5)
+        assert pump(selector, future.done)
+        assert future.result() == 42
+
+        # second_client is never processed, so its request times out
+        gathered = messaging.gather_requests([server, second_server], "echo", 1, request_kwargs={"value": 1})
+        assert pump(selector, lambda: not server.requests_outstanding)
+        assert not gathered.done()
+        second_server.expire_requests(messaging.monotonic() + 2)
+        results = gathered.result(timeout=1)
+        assert list(results.keys()) == [server, second_server]
+        assert results[server] == 1
+        assert isinstance(results[second_server], messaging.futures.TimeoutError)
+        assert messaging.gather_requests([], "echo", 1).result() == {}
+    finally:
+        messaging.ConnectionManager.requests_callbacks.pop("echo")
+        for connection in (server, client, second_server, second_client):
+            connection.socket.close()
+        selector.close()
+        second_selector.close()
+
+
+def test_pooled_handlers():
+    selector, (server, client) = connected_pair()
+    release = threading.Event()
+    responses, actions = [], []
+
+    def slow(connection, value=None):
+        release.wait(5)
+        return value
+
+    messaging.request_callback("slow", pooled=True)(slow)
+    messaging.request_callback("fast")(lambda connection, value=None: value)
+    messaging.message_callback("slow_action", pooled=True)(lambda connection: actions.append(release.wait(5)))
+    try:
+        on_response = lambda connection, value: responses.append(value)
+        server.get_response("slow", on_response, request_kwargs={"value": "slow"})
+        server.send_message("slow_action")
+        server.get_response("fast", on_response, request_kwargs={"value": "fast"})
+        # inline handler is answered while pooled ones block
+        assert pump(selector, lambda: responses == ["fast"])
+        assert not actions
+
+        release.set()
+        assert pump(selector, lambda: responses == ["fast", "slow"] and actions == [True])
+        assert client.run_action("slow_action") and not client.run_action("missing")
+    finally:
+        release.set()
+        for name in ("slow", "fast"):
+            messaging.ConnectionManager.requests_callbacks.pop(name)
+        messaging.ConnectionManager.messages_callbacks.pop("slow_action")
+        for connection in (server, client):
+            connection.socket.close()
+        selector.close()
+
+
+def test_handler_pool_starts_threads_for_queued_handlers():
+    pool = messaging.HandlerPool(workers=2)
+    release = threading.Event()
+    running = []
+
+    def handler():
+        running.append(threading.current_thread())
+        release.wait(5)
+
+    try:
+        pool.submit("first", lambda: None)
+        deadline = time.time() + 5
+        while pool._idle != 1 and time.time() < deadline:
+            time.sleep(0.01)
+        assert pool._idle == 1
+
+        pool.submit("second", handler)
+        pool.submit("third", handler)  # idle thread is notified, but has not taken its handler yet
+        deadline = time.time() + 5
+        while len(running) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(set(running)) == 2
+    finally:
+        release.set()
+
+
+def test_send_priorities():
+    directory = tempfile.mkdtemp()
+    selector, (sender, receiver) = connected_pair()
+    received = []
+    messaging.ConnectionManager.messages_callbacks["test"] = lambda connection, **kwargs: received.append(kwargs)
+    try:
+        assert pump(selector, lambda: sender.use_binary_header and not sender._writing)
+        source = os.path.join(directory, "source.bin")
+        with open(source, 'wb') as f:
+            f.write(os.urandom(16 * messaging.FileStream.chunk_size))
+        sender.send_file(source, os.path.join(directory, "destination.bin"))
+        sender.send_message("test", kwargs={"value": "normal"}, priority=messaging.PRIORITY_NORMAL)
+        sender.write()
+        assert len(sender._send_queues[messaging.PRIORITY_BULK]) == 1  # file is still being sent
+
+        sender.send_message("test", kwargs={"value": "control"})
+        while sender._send_buffers:
+            sender.write()
+        sender.write()  # control message goes before next file chunk
+        assert sender._send_queues[messaging.PRIORITY_BULK][0][1].offset == 2 * messaging.FileStream.chunk_size
+
+        assert pump(selector, lambda: len(received) == 2)
+        assert received == [{"value": "normal"}, {"value": "control"}]
+        assert sender.queue_delays.count[messaging.PRIORITY_CONTROL] == 2  # with capabilities
+        assert pump(selector, lambda: not sender._writing)
+    finally:
+        messaging.ConnectionManager.messages_callbacks.pop("test")
+        for connection in (sender, receiver):
+            connection.socket.close()
+        selector.close()
+        shutil.rmtree(directory)
+
+
+def test_send_queue_limits():
+    directory = tempfile.mkdtemp()
+    selector, (sender, receiver) = connected_pair()
+    try:
+        assert pump(selector, lambda: sender.use_binary_header and not sender._writing)
+        assert sender.send_queue_depth == (0, 0)
+        sender.send_queue_messages = 5
+
+        for i in range(10):
+            sender.send_message("telemetry", kwargs={"value": i}, priority=messaging.PRIORITY_NORMAL,
+                                droppable=True)
+            if i == 2:
+                sender._send_response("test", "1", i)  # responses are never dropped
+        assert sender.send_queue_depth[0] == 5 and sender.messages_dropped == 6
+        queued = [messaging.MessageManager() for _ in range(5)]
+        for message, (_, data, _) in zip(queued, sender._send_queues[messaging.PRIORITY_NORMAL]):
+            message.process_message(messaging.ReceiveBuffer.from_bytes(data))
+        assert [message.content.get("kwargs", message.content).get("value") for message in queued] == \
+            [2, 6, 7, 8, 9]  # oldest telemetry dropped
+
+        source = os.path.join(directory, "source.bin")
+        with open(source, 'wb') as f:
+            f.write(b"data")
+        sender.send_file(source, os.path.join(directory, "destination.bin"))  # bulk fails
+        assert not sender._send_queues[messaging.PRIORITY_BULK]
+        sender.send_message("land")  # control is never dropped
+        assert sender.send_queue_depth[0] == 6 and sender.messages_dropped == 7
+        sender.send_queue_messages = 1
+        sender._send_response("test", "2", "value")  # exceeds the limit when there is no telemetry left to drop
+        assert sender.send_queue_depth[0] == 3 and sender.messages_dropped == 11
+
+        assert pump(selector, lambda: sender.send_queue_depth == (0, 0))
+    finally:
+        for connection in (sender, receiver):
+            connection.socket.close()
+        selector.close()
+        shutil.rmtree(directory)
+
+
+def test_chunked_file_transfer():
+    directory = tempfile.mkdtemp()
+    selector, (sender, receiver) = connected_pair()
+    try:
+        source = os.path.join(directory, "source.bin")
+        with open(source, 'wb') as f:
+            f.write(os.urandom(300 * 1024))
+        destination = os.path.join(directory, "destination.bin")
+        requested = os.path.join(directory, "requested.bin")
+        responses = []
+
+        assert pump(selector, lambda: sender.peer_capabilities.get("file_chunks") and
+                    receiver.peer_capabilities.get("file_chunks"))
+        sender.send_file(source, destination)
+        assert pump(selector, lambda: os.path.exists(destination))
+        assert os.stat(destination).st_mode & 0o777 == 0o666 & ~messaging._UMASK
+        os.chmod(destination, 0o750)  # mode of overwritten file is kept
+        replaced = os.stat(destination).st_ino
+        sender.send_file(source, destination)
+        assert pump(selector, lambda: os.stat(destination).st_ino != replaced)
+        assert os.stat(destination).st_mode & 0o777 == 0o750
+
+        receiver.get_file(source, requested, callback=lambda connection, value, **kwargs: responses.append(value))
+        assert pump(selector, lambda: responses)
+
+        for path in (destination, requested):
+            with open(source, 'rb') as f, open(path, 'rb') as g:
+                assert f.read() == g.read()
+        assert responses == [True]
+        with open(source, 'rb') as f:
+            assert messaging.file_hash(destination) == hashlib.sha256(f.read()).hexdigest()
+        assert messaging.file_hash(os.path.join(directory, "missing.bin")) is None
+        assert not [name for name in os.listdir(directory) if name.endswith(".part")]
+        # receive size grows beyond minimal buffer size under bulk transfer
+        assert receiver.io_stats.bytes_per_recv > 2 * receiver.buffer_size
+        assert sender.io_stats.bytes_per_send > 2 * sender.buffer_size
+
+        # peers without chunks support get whole file in one message, even if it exceeds send queue byte limit
+        for connection in (sender, receiver):
+            connection.peer_capabilities.pop("file_chunks")
+            connection.send_queue_bytes = 64 * 1024
+        legacy = os.path.join(directory, "legacy.bin")
+        sender.send_file(source, legacy)
+        receiver.get_file(source, requested + ".legacy",
+                          callback=lambda connection, value, **kwargs: responses.append(value))
+        assert pump(selector, lambda: len(responses) == 2 and os.path.exists(legacy))
+        for path in (legacy, requested + ".legacy"):
+            assert messaging.file_hash(path) == messaging.file_hash(source)
+    finally:
+        for connection in (sender, receiver):
+            connection.socket.close()
+        selector.close()
+        shutil.rmtree(directory)
+
+
+def test_bulk_messages_follow_files():
+    directory = tempfile.mkdtemp()
+    selector, (sender, receiver) = connected_pair()
+    destination = os.path.join(directory, "destination.bin")
+    handled, responses = [], []
+    messaging.ConnectionManager.messages_callbacks["after_file"] = \
+        lambda connection: handled.append(("after_file", os.path.exists(destination)))
+    messaging.request_callback("after_file")(lambda connection: os.path.exists(destination))
+    try:
+        source = os.path.join(directory, "source.bin")
+        with open(source, 'wb') as f:
+            f.write(os.urandom(5 * messaging.FileStream.chunk_size))
+
+        assert pump(selector, lambda: sender.peer_capabilities.get("file_chunks"))
+        sender.send_file(source, destination)
+        sender.get_response("after_file", lambda connection, value: responses.append(value),
+                            priority=messaging.PRIORITY_BULK)
+        sender.send_message("after_file", priority=messaging.PRIORITY_BULK)
+        assert pump(selector, lambda: handled and responses)
+        assert handled == [("after_file", True)] and responses == [True]
+    finally:
+        messaging.ConnectionManager.messages_callbacks.pop("after_file")
+        messaging.ConnectionManager.requests_callbacks.pop("after_file")
+        for connection in (sender, receiver):
+            connection.socket.close()
+        selector.close()
+        shutil.rmtree(directory)
+
+
+def test_file_streams_open_files_one_at_a_time():
+    directory = tempfile.mkdtemp()
+    selector, (sender, receiver) = connected_pair()
+    try:
+        assert pump(selector, lambda: sender.use_binary_header and not sender._writing)
+        sources = []
+        for name in ("first.bin", "second.bin", "truncated.bin"):
+            sources.append(os.path.join(directory, name))
+            with open(sources[-1], 'wb') as f:
+                f.write(os.urandom(3 * messaging.FileStream.chunk_size))
+        for source in sources:
+            sender.send_file(source, source + ".copy")
+        streams = [stream for _, stream, _ in sender._send_queues[messaging.PRIORITY_BULK]]
+        assert not [stream for stream in streams if stream._file is not None]  # opened when sent
+
+        sender.write()
+        assert [stream._file is not None for stream in streams] == [True, False, False]
+        assert [stream.offset for stream in streams] == [messaging.FileStream.chunk_size, 0, 0]
+
+        with open(sources[2], 'wb') as f:
+            f.write(b"short")
+        assert pump(selector, lambda: not sender._writing)
+        assert all(stream.finished and stream._file is None for stream in streams)
+        assert sender.send_queue_depth == (0, 0)
+        for source in sources[:2]:
+            with open(source, 'rb') as f, open(source + ".copy", 'rb') as g:
+                assert f.read() == g.read()
+        assert not os.path.exists(sources[2] + ".copy")
+    finally:
+        for connection in (sender, receiver):
+            connection.socket.close()
+        selector.close()
+        shutil.rmtree(directory)
+
+
+@pytest.mark.skipif(sys.version_info[0] < 3, reason="asyncio transport is Python 3 only")
+def test_asyncio_connection():
+    import asyncio
+    import messaging_asyncio
+
+    directory = tempfile.mkdtemp()
+    loop = asyncio.new_event_loop()
+    selector = selectors.DefaultSelector()
+    messaging.SelectorWaker(selector)
+    threaded_sock, asyncio_sock = socket.socketpair()
+    threaded_sock.setblocking(False)
+    threaded = messaging.ConnectionManager()
+    selector.register(threaded_sock, selectors.EVENT_READ, data=threaded)
+    threaded.connect(selector, threaded_sock, "threaded")
+    connection = messaging_asyncio.AsyncioConnection()
+
+    running = threading.Event()
+    running.set()
+
+    def process():
+        while running.is_set():
+            for key, mask in selector.select(timeout=0.05):
+                key.data.process_events(mask)
+
+    thread = threading.Thread(target=process)
+    thread.start()
+    messaging.ConnectionManager.requests_callbacks["echo"] = lambda connection, value=None: value
+
+    def run_until(condition, timeout=5.0):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            loop.run_until_complete(asyncio.sleep(0.01))
+        return condition()
+
+    def result(future):
+        return loop.run_until_complete(asyncio.wait_for(asyncio.wrap_future(future, loop=loop), 5))
+
+    try:
+        loop.run_until_complete(loop.connect_accepted_socket(
+            lambda: messaging_asyncio.ConnectionProtocol(connection), asyncio_sock))
+        assert result(connection.request("echo", request_kwargs={"value": 42}, timeout=5)) == 42
+        # request from the other side is answered on the event loop
+        assert result(threaded.request("echo", request_kwargs={"value": 7}, timeout=5)) == 7
+
+        source = os.path.join(directory, "source.bin")
+        with open(source, 'wb') as f:
+            f.write(os.urandom(300 * 1024))
+        destination = os.path.join(directory, "destination.bin")
+        connection.send_file(source, destination)
+        assert run_until(lambda: os.path.exists(destination))
+        with open(source, 'rb') as f, open(destination, 'rb') as g:
+            assert f.read() == g.read()
+        assert connection.send_queue_depth == (0, 0)
+
+        threaded.close()
+        assert run_until(lambda: connection.transport is None)
+    finally:
+        messaging.ConnectionManager.requests_callbacks.pop("echo")
+        running.clear()
+        thread.join()
+        loop.close()
+        selector.close()
+        asyncio_sock.close()
+        shutil.rmtree(directory)
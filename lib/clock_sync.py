@@ -0,0 +1,164 @@
+import time
+import socket
+import struct
+import logging
+import threading
+import collections
+
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+NTP_DELTA = 2208988800  # seconds from 1900-01-01 (NTP era) to 1970-01-01
+NTP_PACKET_FORMAT = "!12I"
+NTP_QUERY = b'\x1b' + 47 * b'\0'  # version 3, client mode
+MAX_DRIFT = 500e-6  # clocks are assumed to drift not faster than 500 ppm
+DISPERSION_RATE = 15e-6  # uncertainty growth of estimate since last sync, as NTP assumes
+
+
+def exchange_sample(sent, received, replied, returned):
+    """Return (offset, delay) from four timestamps of request-response exchange.
+
+    sent and returned are local times of request sending and response receiving,
+    received and replied are remote times of request receiving and response sending.
+    Offset is added to local time to get remote time, delay is the round trip excluding remote processing.
+    """
+    offset = ((received - sent) + (replied - returned)) / 2.0
+    delay = (returned - sent) - (replied - received)
+    return offset, delay
+
+
+def ntp_query(host, port=123, timeout=1.0, clock=time.time):
+    """Query NTP server once, return (offset, delay) of local clock in seconds.
+
+    Offset is added to local time to get server time, delay is the network round trip
+    excluding server processing time.
+    """
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+        s.settimeout(timeout)
+        sent = clock()
+        s.sendto(NTP_QUERY, (host, port))
+        msg, address = s.recvfrom(1024)
+        received = clock()
+    unpacked = struct.unpack(NTP_PACKET_FORMAT, msg[0:struct.calcsize(NTP_PACKET_FORMAT)])
+    server_received = unpacked[8] + float(unpacked[9]) / 2 ** 32 - NTP_DELTA
+    server_sent = unpacked[10] + float(unpacked[11]) / 2 ** 32 - NTP_DELTA
+    return exchange_sample(sent, server_received, server_sent, received)
+
+
+class ClockSync(object):
+    """Offset of local clock to NTP server, refreshed by background thread.
+
+    Every `interval` seconds a burst of queries is sent and the one with minimal round trip is used,
+    as it is the least delayed by network queues. Offset is smoothed with exponential filter and extrapolated
+    with estimated drift, so time_now() never waits for the network.
+    """
+    def __init__(self, host, port=123, interval=64.0, burst=4, timeout=1.0, smoothing=0.5, query=ntp_query):
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.burst = burst
+        self.timeout = timeout
+        self.smoothing = smoothing
+        self._query = query
+
+        # (offset, drift, synced_on, uncertainty) replaced as a whole, so readers need no lock
+        self._estimate = (0.0, 0.0, None, None)
+
+        self._thread = threading.Thread(target=self._run, name="Clock sync")
+        self._thread.daemon = True
+        self._stop_event = threading.Event()
+
+    @property
+    def synced(self):
+        return self._estimate[2] is not None
+
+    def start(self):
+        logger.info("Starting clock sync with {}:{} every {} s".format(self.host, self.port, self.interval))
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def time_now(self):
+        offset, drift, synced_on, _ = self._estimate
+        now = time.time()
+        if synced_on is None:
+            return now
+        return now + offset + drift * (now - synced_on)
+
+    def offset(self, now=None):
+        """Current estimate of offset of local clock in seconds."""
+        offset, drift, synced_on, _ = self._estimate
+        if synced_on is None:
+            return 0.0
+        return offset + drift * ((time.time() if now is None else now) - synced_on)
+
+    def status(self):
+        """Return (offset, uncertainty, last sync age) in seconds or None before the first sync."""
+        offset, drift, synced_on, uncertainty = self._estimate
+        if synced_on is None:
+            return None
+        now = time.time()
+        age = now - synced_on
+        return offset + drift * age, uncertainty + DISPERSION_RATE * age, age
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.sync()
+            self._stop_event.wait(self.interval)
+
+    def sync(self):
+        """Query burst of samples and update estimate with the best one. Returns False if no sample was received."""
+        samples = []
+        for i in range(self.burst):
+            try:
+                samples.append(self._query(self.host, self.port, self.timeout))
+            except (socket.error, socket.timeout, struct.error) as error:
+                logger.debug("NTP query to {} failed: {}".format(self.host, error))
+            if i + 1 < self.burst and self._stop_event.wait(0.1):
+                break
+
+        if not samples:
+            logger.warning("Can not sync clock with {}: no response".format(self.host))
+            return False
+
+        measured, delay = min(samples, key=lambda sample: sample[1])
+        self.add_sample(measured, delay)
+        return True
+
+    def add_sample(self, measured, delay, now=None):
+        if now is None:
+            now = time.time()
+        offset, drift, synced_on, _ = self._estimate
+        if synced_on is None:
+            offset = measured
+        else:
+            elapsed = now - synced_on
+            predicted = offset + drift * elapsed
+            residual = measured - predicted
+            offset = predicted + self.smoothing * residual
+            if elapsed > 0:
+                drift += self.smoothing * residual / elapsed
+                drift = max(-MAX_DRIFT, min(drift, MAX_DRIFT))
+        self._estimate = (offset, drift, now, max(delay, 0.0) / 2)
+        logger.debug("Clock offset {:.6f} s, drift {:.2f} ppm, delay {:.6f} s".format(offset, drift * 1e6, delay))
+
+
+class ExchangeFilter(object):
+    """Rolling estimate of remote clock offset and one-way delay from last `window` four timestamp exchanges.
+
+    Offset is taken from the exchange with minimal round trip, delay is half of the median round trip.
+    """
+    def __init__(self, window=8):
+        self.samples = collections.deque(maxlen=window)  # (delay, offset)
+        self.offset = None
+        self.delay = None
+
+    def add(self, sent, received, replied, returned):
+        offset, delay = exchange_sample(sent, received, replied, returned)
+        self.samples.append((delay, offset))
+        self.offset = min(self.samples)[1]
+        delays = sorted(sample[0] for sample in self.samples)
+        self.delay = max(delays[len(delays) // 2], 0.0) / 2
+        return offset, delay
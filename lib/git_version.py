@@ -0,0 +1,131 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def find_git_dir(path):
+    """Return .git directory of repository containing path or None."""
+    path = os.path.abspath(path)
+    while True:
+        git_path = os.path.join(path, '.git')
+        if os.path.isdir(git_path):
+            return git_path
+        if os.path.isfile(git_path):  # worktrees and submodules refer to git directory
+            try:
+                with open(git_path) as f:
+                    content = f.read().strip()
+            except (IOError, OSError):
+                return None
+            if content.startswith('gitdir:'):
+                return os.path.normpath(os.path.join(path, content[len('gitdir:'):].strip()))
+            return None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+class GitVersion(object):
+    """Abbreviated hash of HEAD commit, read from .git files instead of running git.
+
+    HEAD, current branch ref and packed refs are checked for changes at most every `check_interval` seconds,
+    hash is resolved again only when one of them is modified. HEAD of a worktree is read from its own git directory,
+    refs are read from the common directory of the repository.
+    """
+    def __init__(self, path, length=7, check_interval=1.0):
+        self.path = path
+        self.length = length
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._git_dir = None
+        self._common_dir = None  # differs from git directory in worktrees
+        self._watched = ()  # files HEAD is resolved from
+        self._stamps = None
+        self._checked_on = None
+        self._version = None
+
+    @property
+    def version(self):
+        """Abbreviated hash of HEAD commit or None if there is no git repository."""
+        now = time.time()
+        with self._lock:
+            if self._checked_on is None or now - self._checked_on >= self.check_interval:
+                self._checked_on = now
+                self._refresh()
+            return self._version
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size, stat.st_ino
+
+    def _refresh(self):
+        if self._git_dir is None:
+            self._git_dir = find_git_dir(self.path)
+            if self._git_dir is None:
+                return
+            common_dir = self._read(os.path.join(self._git_dir, 'commondir'))
+            self._common_dir = self._git_dir if common_dir is None else \
+                os.path.normpath(os.path.join(self._git_dir, common_dir.strip()))
+
+        stamps = [self._stamp(path) for path in self._watched]
+        if self._stamps is not None and stamps == self._stamps:
+            return
+
+        head, self._watched = self._resolve_head()
+        self._stamps = [self._stamp(path) for path in self._watched]
+        version = head[:self.length] if head is not None else None
+        if version != self._version:
+            logger.info("Git version: {}".format(version))
+        self._version = version
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def _resolve_head(self):
+        """Return (commit hash or None, paths of files it is read from)."""
+        head_path = os.path.join(self._git_dir, 'HEAD')
+        packed_refs_path = os.path.join(self._common_dir, 'packed-refs')
+        watched = [head_path, packed_refs_path]
+        head = self._read(head_path)
+        if head is None:
+            return None, watched
+        head = head.strip()
+        if not head.startswith('ref:'):  # detached HEAD
+            return head, watched
+
+        ref = head[len('ref:'):].strip()
+        ref_path = os.path.join(self._common_dir, *ref.split('/'))
+        watched.append(ref_path)
+        commit = self._read(ref_path)
+        if commit is not None:
+            return commit.strip(), watched
+
+        for line in (self._read(packed_refs_path) or '').splitlines():
+            if line.startswith(('#', '^')):
+                continue
+            parts = line.split()
+            if len(parts) == 2 and parts[1] == ref:
+                return parts[0], watched
+        return None, watched  # branch without commits
+
+
+_lib_dir = os.path.dirname(os.path.realpath(__file__))
+_current = GitVersion(_lib_dir)
+
+
+def get_git_version():
+    """Abbreviated hash of HEAD commit of clever-show repository or None, cached until repository changes."""
+    return _current.version
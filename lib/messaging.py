@@ -2,13 +2,20 @@ import io
 import os
 import sys
 import json
+import stat
+import time
+import zlib
+import heapq
 import socket
+import hashlib
 import struct
-import random
 import logging
 import threading
 import collections
+import tempfile
 import platform
+import weakref
+import itertools
 import traceback
 
 from contextlib import closing
@@ -18,6 +25,17 @@ try:
 except ImportError:
     import selectors2 as selectors
 
+try:
+    from concurrent import futures
+except ImportError:  # Python 2 without futures backport
+    futures = None
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # Windows
+    fcntl = None
+
 
 class Namespace:
     def __init__(self, **kwargs):
@@ -33,6 +51,24 @@ class Namespace:
 class PendingRequest(Namespace): pass
 
 
+# Clock for request deadlines, not affected by system time changes where available
+monotonic = getattr(time, "monotonic", time.time)
+
+
+# Send queue priority classes, lower are sent first
+PRIORITY_CONTROL = 0  # commands
+PRIORITY_NORMAL = 1  # telemetry, requests and responses
+PRIORITY_BULK = 2  # file transfers and messages which must follow them
+PRIORITY_NAMES = ("control", "normal", "bulk")
+
+# Policies applied to message of priority class when send queue is full
+POLICY_DROP_OLDEST = "drop_oldest"  # drop oldest droppable messages of the same class, e.g. telemetry
+POLICY_FAIL = "fail"  # reject message
+
+# Content is compressed with zlib at given level when it is larger than threshold
+Compression = collections.namedtuple("Compression", ["threshold", "level"])
+
+
 logger = logging.getLogger(__name__)
 
 
@@ -83,7 +119,91 @@ class _Singleton(type):
 class Singleton(_Singleton('SingletonMeta', (object,), {})): pass
 
 
+class ReceiveBuffer(object):
+    """Growable receive buffer: bytes are written by recv_into and read back as memoryviews.
+
+    Consumed head is dropped by moving offsets, so framing a message does not copy the data.
+    Memoryviews returned by peek/consume are only valid until the next write to the buffer.
+    """
+    def __init__(self, size=1024):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    @classmethod
+    def from_bytes(cls, data):
+        buffer = cls(len(data))
+        buffer.extend(data)
+        return buffer
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def capacity(self):
+        return len(self._buffer)
+
+    def reserve(self, size):
+        """Make sure at least `size` bytes can be written after the buffered data."""
+        if len(self._buffer) - self._end >= size:
+            return
+
+        length = self._end - self._start
+        if len(self._buffer) - length >= size:  # enough space after compacting
+            self._buffer[:length] = self._buffer[self._start:self._end]
+        else:
+            buffer = bytearray(max(len(self._buffer) * 2, length + size))
+            buffer[:length] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        self._start, self._end = 0, length
+
+    def write_view(self, size):
+        """Return writable memoryview of `size` bytes to be filled by recv_into, then call commit."""
+        self.reserve(size)
+        return self._view[self._end:self._end + size]
+
+    def commit(self, size):
+        self._end += size
+
+    def extend(self, data):
+        size = len(data)
+        self.write_view(size)[:] = data
+        self.commit(size)
+
+    def peek(self, size):
+        return self._view[self._start:min(self._start + size, self._end)]
+
+    def consume(self, size):
+        start, end = self._start, min(self._start + size, self._end)
+        if end == self._end:  # everything read, rewind without copying
+            self._start = self._end = 0
+        else:
+            self._start = end
+        return self._view[start:end]
+
+    def read_all(self):
+        return self.consume(len(self)).tobytes()
+
+    def clear(self):
+        self._start = self._end = 0
+
+
 class MessageManager:
+    # Compact header: marker in place of JSON header length, then message type, content type, flags,
+    # content length and lengths of name (action or requested value) and request id strings that follow
+    BINARY_HEADER_MARKER = 0xFFFF
+    FLAG_ZLIB = 0x01
+    _binary_header = struct.Struct(">BBBIBB")
+    _message_types = ("message", "request", "response")
+    _content_types = ("json", "binary")
+    _binary_header_fields = {
+        "message": ("action", None),
+        "request": (None, None),
+        "response": ("requested_value", "request_id"),
+    }
+
     def __init__(self):
         self.income_raw = b""
         self._jsonheader_len = None
@@ -96,13 +216,58 @@ class MessageManager:
 
     @staticmethod
     def _json_decode(json_bytes, encoding="utf-8"):
-        with io.TextIOWrapper(io.BytesIO(json_bytes), encoding=encoding, newline="") as tiow:
-            obj = json.load(tiow, object_pairs_hook=collections.OrderedDict)
-        return obj
+        if isinstance(json_bytes, memoryview):
+            json_bytes = json_bytes.tobytes()
+        return json.loads(json_bytes.decode(encoding), object_pairs_hook=collections.OrderedDict)
+
+    @staticmethod
+    def _compress(content_bytes, compression):
+        """Return compressed content or None if compression is disabled or does not reduce size."""
+        if compression is None or not compression.threshold or len(content_bytes) < compression.threshold:
+            return None
+
+        compressed = zlib.compress(content_bytes, compression.level)
+        logger.debug("Compressed content from {} to {} bytes ({:.0%})".format(
+            len(content_bytes), len(compressed), float(len(compressed)) / len(content_bytes)))
+        if len(compressed) >= len(content_bytes):
+            return None
+        return compressed
+
+    @classmethod
+    def _create_binary_header(cls, content_type, message_type, content_encoding, content_length,
+                              additional_headers, flags=0):
+        """Return packed binary header or None if the headers can be sent only as JSON."""
+        if content_encoding != "utf-8" or content_type not in cls._content_types:
+            return None
+
+        name_key, id_key = cls._binary_header_fields[message_type]
+        headers = dict(additional_headers) if additional_headers else {}
+        name = headers.pop(name_key, "") if name_key else ""
+        request_id = headers.pop(id_key, "") if id_key else ""
+        if headers:
+            return None
+
+        name, request_id = name.encode("utf-8"), str(request_id).encode("utf-8")
+        if len(name) > 255 or len(request_id) > 255:
+            return None
+
+        return struct.pack(">H", cls.BINARY_HEADER_MARKER) + cls._binary_header.pack(
+            cls._message_types.index(message_type), cls._content_types.index(content_type), flags,
+            content_length, len(name), len(request_id)) + name + request_id
 
     @classmethod
     def create_message(cls, content_bytes, content_type, message_type, content_encoding="utf-8",
-                       additional_headers=None):
+                       additional_headers=None, binary_header=False, compression=None):
+        compressed = cls._compress(content_bytes, compression)
+        if compressed is not None:
+            content_bytes = compressed
+
+        if binary_header:
+            header = cls._create_binary_header(content_type, message_type, content_encoding, len(content_bytes),
+                                               additional_headers, cls.FLAG_ZLIB if compressed is not None else 0)
+            if header is not None:
+                return header + content_bytes
+
         jsonheader = {
             "byteorder": sys.byteorder,
             "content-type": content_type,
@@ -110,6 +275,8 @@ class MessageManager:
             "content-length": len(content_bytes),
             "message-type": message_type,
         }
+        if compressed is not None:
+            jsonheader["content-compression"] = "zlib"
         if additional_headers:
             jsonheader.update(additional_headers)
 
@@ -119,20 +286,20 @@ class MessageManager:
         return message
 
     @classmethod
-    def create_json_message(cls, contents, additional_headers=None):
+    def create_json_message(cls, contents, additional_headers=None, **options):
         message = cls.create_message(cls._json_encode(contents), "json", "message",
-                                     additional_headers=additional_headers)
+                                     additional_headers=additional_headers, **options)
         return message
 
     @classmethod
-    def create_action_message(cls, action, args=(), kwargs=None):
+    def create_action_message(cls, action, args=(), kwargs=None, **options):
         if kwargs is None:
             kwargs = {}
-        message = cls.create_json_message({"args": args, "kwargs": kwargs}, {"action": action, })
+        message = cls.create_json_message({"args": args, "kwargs": kwargs}, {"action": action, }, **options)
         return message
 
     @classmethod
-    def create_request(cls, requested_value, request_id, args=(), kwargs=None):
+    def create_request(cls, requested_value, request_id, args=(), kwargs=None, **options):
         if kwargs is None:
             kwargs = {}
         contents = {"requested_value": requested_value,
@@ -140,11 +307,11 @@ class MessageManager:
                     "args": args,
                     "kwargs": kwargs,
                     }
-        message = cls.create_message(cls._json_encode(contents), "json", "request")
+        message = cls.create_message(cls._json_encode(contents), "json", "request", **options)
         return message
 
     @classmethod
-    def create_response(cls, requested_value, request_id, value, filetransfer=False):
+    def create_response(cls, requested_value, request_id, value, filetransfer=False, **options):
         headers = {"requested_value": requested_value,
                    "request_id": request_id,  # TODO status
                    }
@@ -153,20 +320,18 @@ class MessageManager:
         else:
             contents = cls._json_encode({"value": value, })
         message = cls.create_message(contents, "binary" if filetransfer else "json",
-                                     "response", additional_headers=headers)
+                                     "response", additional_headers=headers, **options)
         return message
 
-    def _process_protoheader(self):
+    def _process_protoheader(self, buffer):
         header_len = 2
-        if len(self.income_raw) >= header_len:
-            self._jsonheader_len = struct.unpack(">H", self.income_raw[:header_len])[0]
-            self.income_raw = self.income_raw[header_len:]
+        if len(buffer) >= header_len:
+            self._jsonheader_len = struct.unpack_from(">H", buffer.consume(header_len))[0]
 
-    def _process_jsonheader(self):
+    def _process_jsonheader(self, buffer):
         header_len = self._jsonheader_len
-        if len(self.income_raw) >= header_len:
-            self.jsonheader = self._json_decode(self.income_raw[:header_len], "utf-8")
-            self.income_raw = self.income_raw[header_len:]
+        if len(buffer) >= header_len:
+            self.jsonheader = self._json_decode(buffer.consume(header_len), "utf-8")
             for reqhdr in (
                     "byteorder",
                     "content-length",
@@ -177,33 +342,335 @@ class MessageManager:
                 if reqhdr not in self.jsonheader:
                     raise ValueError('Missing required header {}'.format(reqhdr))
 
-    def _process_content(self):
+    def _process_binaryheader(self, buffer):
+        fixed_len = self._binary_header.size
+        if len(buffer) < fixed_len:
+            return
+        message_type, content_type, flags, content_len, name_len, id_len = \
+            self._binary_header.unpack_from(buffer.peek(fixed_len))
+        if len(buffer) < fixed_len + name_len + id_len:
+            return
+
+        buffer.consume(fixed_len)
+        name = buffer.consume(name_len).tobytes().decode("utf-8")
+        request_id = buffer.consume(id_len).tobytes().decode("utf-8")
+
+        message_type = self._message_types[message_type]
+        header = collections.OrderedDict([
+            ("byteorder", sys.byteorder),
+            ("content-type", self._content_types[content_type]),
+            ("content-encoding", "utf-8"),
+            ("content-length", content_len),
+            ("message-type", message_type),
+        ])
+        if flags & self.FLAG_ZLIB:
+            header["content-compression"] = "zlib"
+        name_key, id_key = self._binary_header_fields[message_type]
+        if name_key:
+            header[name_key] = name
+        if id_key:
+            header[id_key] = request_id
+        self.jsonheader = header
+
+    def _process_content(self, buffer):
         content_len = self.jsonheader["content-length"]
-        if not len(self.income_raw) >= content_len:
+        if not len(buffer) >= content_len:
             return
-        data = self.income_raw[:content_len]
-        self.income_raw = self.income_raw[content_len:]
+        data = buffer.consume(content_len)
+        compression = self.jsonheader.get("content-compression", None)
+        if compression == "zlib":
+            data = zlib.decompress(data.tobytes())
+        elif compression is not None:
+            raise ValueError("Unsupported content compression {}".format(compression))
+
         if self.jsonheader["content-type"] == "json":
             encoding = self.jsonheader["content-encoding"]
             self.content = self._json_decode(data, encoding)
         else:
-            self.content = data
+            self.content = data.tobytes() if isinstance(data, memoryview) else data
+
+    def process_message(self, buffer=None):
+        """Parse message from ReceiveBuffer (consuming only own bytes) or from income_raw if no buffer given."""
+        if buffer is None:
+            buffer = ReceiveBuffer.from_bytes(self.income_raw)
+            self.process_message(buffer)
+            self.income_raw = buffer.read_all()
+            return
 
-    def process_message(self):
         if self._jsonheader_len is None:
-            self._process_protoheader()
+            self._process_protoheader(buffer)
 
         if self._jsonheader_len is not None:
             if self.jsonheader is None:
-                self._process_jsonheader()
+                if self._jsonheader_len == self.BINARY_HEADER_MARKER:
+                    self._process_binaryheader(buffer)
+                else:
+                    self._process_jsonheader(buffer)
+                if self.jsonheader is not None:
+                    # preallocate space for the whole content to avoid buffer regrowth while receiving
+                    buffer.reserve(self.jsonheader["content-length"] - len(buffer))
 
         if self.jsonheader:
             if self.content is None:
-                self._process_content()
+                self._process_content(buffer)
+
+
+class FileStream(object):
+    """Outgoing file split into 'filechunk' messages on demand.
+
+    The file is opened when its first chunk is sent and closed after the last one,
+    so queued streams hold no file descriptors and only the chunk being sent is held in memory.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, filepath, transfer_id, dest_filepath=None, request_id=None, chunk_size=None):
+        self.filepath = filepath
+        self.dest_filepath = dest_filepath
+        self.transfer_id = transfer_id
+        self.request_id = request_id
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
+        self.size = os.stat(filepath).st_size
+        self._file = None
+        self.offset = 0
+        self.sent = 0
+        self.finished = False
+
+    def __repr__(self):
+        return "FileStream({}, {}/{} bytes)".format(self.filepath, self.offset, self.size)
+
+    def next_message(self, **options):
+        """Return message with next chunk. Raises IOError if file can not be read or was truncated."""
+        if self._file is None:
+            self._file = open(self.filepath, 'rb')
+        expected = min(self.chunk_size, self.size - self.offset)
+        self._file.seek(self.offset)
+        chunk = self._file.read(expected)
+        if len(chunk) < expected:
+            raise IOError("File {} was truncated while sending".format(self.filepath))
+        headers = {"action": "filechunk",
+                   "filepath": self.dest_filepath,
+                   "transfer_id": self.transfer_id,
+                   "offset": self.offset,
+                   "total_length": self.size,
+                   }
+        if self.request_id is not None:
+            headers["request_id"] = self.request_id
+
+        self.offset += len(chunk)
+        self.finished = self.offset >= self.size
+        message = MessageManager.create_message(chunk, "binary", "message", additional_headers=headers, **options)
+        self.sent += len(message)
+        if self.finished and self.size:
+            logger.info("File {} streamed: {} bytes as {} bytes ({:.0%})".format(
+                self.filepath, self.size, self.sent, float(self.sent) / self.size))
+        return message
 
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class FileReceiver(object):
+    """Incoming chunked file, written to a temporary file and renamed to destination when complete."""
+    def __init__(self, filepath, size, request=None):
+        self.filepath = filepath
+        self.size = size
+        self.request = request
+        self.received = 0
+
+        directory, filename = os.path.split(os.path.abspath(filepath))
+        fd, self._temp_path = tempfile.mkstemp(prefix=".{}.".format(filename), suffix=".part", dir=directory)
+        self._file = os.fdopen(fd, 'wb')
+
+    @property
+    def complete(self):
+        return self.received >= self.size
+
+    def write(self, offset, data):
+        if offset != self.received:
+            raise ValueError("Unexpected chunk offset {}, expected {}".format(offset, self.received))
+        self._file.write(data)
+        self.received += len(data)
+
+    def finish(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        os.chmod(self._temp_path, _file_mode(self.filepath))  # mkstemp creates file readable by owner only
+        self._file.close()
+        _replace(self._temp_path, self.filepath)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._temp_path)
+        except OSError as error:
+            logger.error("Temporary file {} can not be removed: {}".format(self._temp_path, error))
+
+
+_UMASK = os.umask(0)  # read once at import, as umask can only be read by setting it
+os.umask(_UMASK)
+
+
+def _file_mode(filepath):
+    """Return permissions of existing file or default permissions of new file."""
+    try:
+        return stat.S_IMODE(os.stat(filepath).st_mode)
+    except OSError:
+        return 0o666 & ~_UMASK
+
+
+def _replace(src, dst):
+    try:
+        os.replace(src, dst)
+    except AttributeError:  # Python 2: rename is atomic and overwrites on POSIX
+        os.rename(src, dst)
+
+
+def file_hash(filepath, chunk_size=FileStream.chunk_size):
+    """Return hex SHA-256 digest of file contents or None if file can not be read."""
+    digest = hashlib.sha256()
+    try:
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    except (OSError, IOError):
+        return None
+    return digest.hexdigest()
+
+
+class IOStats(object):
+    """Per-connection counters of socket calls and transferred bytes."""
+    __slots__ = ("recv_calls", "recv_bytes", "send_calls", "send_bytes")
+
+    def __init__(self):
+        self.recv_calls = 0
+        self.recv_bytes = 0
+        self.send_calls = 0
+        self.send_bytes = 0
 
-def message_callback(action_string):
+    def __repr__(self):
+        return "IOStats(recv: {} calls, {:.0f} bytes/call; send: {} calls, {:.0f} bytes/call)".format(
+            self.recv_calls, self.bytes_per_recv, self.send_calls, self.bytes_per_send)
+
+    @property
+    def bytes_per_recv(self):
+        return float(self.recv_bytes) / self.recv_calls if self.recv_calls else 0.0
+
+    @property
+    def bytes_per_send(self):
+        return float(self.send_bytes) / self.send_calls if self.send_calls else 0.0
+
+
+class QueueDelayStats(object):
+    """Per-connection time spent by messages of each priority class in send queue."""
+    def __init__(self):
+        self.count = [0] * len(PRIORITY_NAMES)
+        self.total = [0.0] * len(PRIORITY_NAMES)
+        self.max = [0.0] * len(PRIORITY_NAMES)
+
+    def __repr__(self):
+        return "QueueDelayStats({})".format("; ".join(
+            "{}: {} messages, avg {:.1f} ms, max {:.1f} ms".format(
+                name, self.count[priority], self.average(priority) * 1000, self.max[priority] * 1000)
+            for priority, name in enumerate(PRIORITY_NAMES)))
+
+    def add(self, priority, delay):
+        self.count[priority] += 1
+        self.total[priority] += delay
+        self.max[priority] = max(self.max[priority], delay)
+
+    def average(self, priority):
+        return self.total[priority] / self.count[priority] if self.count[priority] else 0.0
+
+
+def gather_requests(connections, requested_value, timeout, request_args=(), request_kwargs=None):
+    """Send the same request to all connections.
+
+    Returns future resolved when every connection has answered or timed out with OrderedDict
+    of connection: response value or exception (futures.TimeoutError for connections without response).
+    """
+    gathered = futures.Future()
+    requests = collections.OrderedDict((connection, connection.request(requested_value, request_args,
+                                                                       request_kwargs, timeout))
+                                       for connection in connections)
+    lock = threading.Lock()
+    waiting = [len(requests)]
+
+    def done(_future):
+        with lock:
+            waiting[0] -= 1
+            if waiting[0]:
+                return
+        results = collections.OrderedDict()
+        for connection, future in requests.items():
+            results[connection] = future.exception() if future.exception() is not None else future.result()
+        gathered.set_result(results)
+
+    if not requests:
+        gathered.set_result(collections.OrderedDict())
+    for future in requests.values():
+        future.add_done_callback(done)
+    return gathered
+
+
+class HandlerPool(object):
+    """Bounded thread pool running slow message and request handlers off the selector thread.
+
+    Threads are started on demand up to `workers`; handlers submitted while `max_queued` handlers wait are rejected.
+    """
+    def __init__(self, workers=2, max_queued=32):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.rejected = 0
+
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._handlers_available = threading.Condition(self._lock)
+        self._threads = []
+        self._idle = 0
+
+    def submit(self, name, f, *args, **kwargs):
+        """Queue f(*args, **kwargs) to run in pool. Returns False if pool queue is full."""
+        with self._lock:
+            if len(self._queue) >= self.max_queued:
+                self.rejected += 1
+                logger.warning("Handler pool is full ({} queued), {} rejected".format(len(self._queue), name))
+                return False
+            self._queue.append((name, f, args, kwargs))
+            # notified idle threads may not have taken their handlers yet, so compare with all queued handlers
+            if len(self._queue) > self._idle and len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name="Handler pool {}".format(len(self._threads)))
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+            self._handlers_available.notify()
+        return True
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._idle += 1
+                    self._handlers_available.wait()
+                    self._idle -= 1
+                name, f, args, kwargs = self._queue.popleft()
+
+            logger.debug("Running pooled handler {}".format(name))
+            try:
+                f(*args, **kwargs)
+            except Exception as error:
+                logger.error("Error during pooled handler {} execution: {}".format(name, error))
+                traceback.print_exc()
+
+
+def message_callback(action_string, pooled=False):
+    """Register handler of action messages. Pooled handlers run in ConnectionManager.handler_pool,
+    use it for handlers which block for long, so the connection keeps reading meanwhile."""
     def inner(f):
+        f.pooled = pooled
         ConnectionManager.messages_callbacks[action_string] = f
         logger.debug("Registered message function {} for {}".format(f, action_string))
 
@@ -215,8 +682,11 @@ def message_callback(action_string):
     return inner
 
 
-def request_callback(string_command):
+def request_callback(string_command, pooled=False):
+    """Register handler of requests. Response of pooled handler is sent when it finishes in
+    ConnectionManager.handler_pool."""
     def inner(f):
+        f.pooled = pooled
         ConnectionManager.requests_callbacks[string_command] = f
         logger.debug("Registered callback function {} for {}".format(f, string_command))
 
@@ -231,30 +701,60 @@ def request_callback(string_command):
 class ConnectionManager(object):
     messages_callbacks = {}
     requests_callbacks = {}
+    handler_pool = HandlerPool()  # runs pooled handlers of all connections
 
     def __init__(self, whoami="computer"):
         self.selector = None
+        self._waker = None
         self.socket = None
         self.addr = None
 
         self._should_close = False
 
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self._recv_buffer = ReceiveBuffer()
+        self._send_buffers = collections.deque()  # memoryviews of messages being sent
+        self._writing = False  # selector listens for write events
+        self._send_buffer_size = 0  # effective SO_SNDBUF of connected socket
+        self._recv_buffer_size = 0  # effective SO_RCVBUF of connected socket
+        self._recv_size = 0  # adaptive amount of bytes to receive per call
+        self.io_stats = IOStats()
 
         self.whoami = whoami
 
-        self._send_queue = collections.deque()
+        self._send_queues = tuple(collections.deque() for _ in PRIORITY_NAMES)  # of (queued_on, message, droppable)
+        self._queued_messages = 0  # in send queues and not yet sent buffers
+        self._queued_bytes = 0
+        self.queue_delays = QueueDelayStats()
+        self.messages_dropped = 0
         self._received_queue = collections.deque()
         self._request_queue = collections.OrderedDict()
+        self._request_deadlines = []  # heap of (expires_on, request_id)
+        self._request_ids = itertools.count(1)
+        self.requests_expired = 0
+        self._file_receivers = {}
+        self._transfer_ids = itertools.count()
 
         self._send_lock = threading.Lock()
         self._request_lock = threading.Lock()
         self._close_lock = threading.Lock()
 
-        self.buffer_size = 1024
+        self.buffer_size = 1024  # minimal amount of bytes to receive per call
+        # limits of queued and not yet sent data, control messages are never dropped
+        self.send_queue_messages = 1000
+        self.send_queue_bytes = 4 * 1024 * 1024
+        self.queue_policies = {PRIORITY_NORMAL: POLICY_DROP_OLDEST, PRIORITY_BULK: POLICY_FAIL}
+        self.socket_sndbuf = 0  # SO_SNDBUF to set on connect, 0 to keep system default
+        self.socket_rcvbuf = 0  # SO_RCVBUF to set on connect, 0 to keep system default
         self.resume_queue = False
         self.resend_requests = True
+        self.request_timeout = 30.0  # seconds, None or 0 to wait for response forever
+        self.binary_header = True
+        self.compression_threshold = 4096  # bytes, 0 to disable compression
+        self.compression_level = 6
+        self.session_id = None  # identifies this side to the peer on connect, e.g. copter id
+        self.extra_capabilities = {}  # application features announced to the peer on connect
+
+        self.peer_capabilities = {}
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', 'rw'."""
@@ -275,29 +775,128 @@ class ConnectionManager(object):
         self.selector = client_selector
         self.socket = client_socket
         self.addr = client_addr
+        self._waker = SelectorWaker.get(client_selector) if client_selector is not None else None
 
         self._clear()
+        self.peer_capabilities = {}
 
-        self._set_selector_events_mask('r')
+        self._setup_socket_buffers()
+        self._recv_size = self.buffer_size
+        self.io_stats = IOStats()
+        with self._send_lock:
+            self._writing = False
+            self._set_selector_events_mask('r')
+        # advertised with JSON header, so peer of any version can read it
+        self._send(MessageManager.create_action_message("capabilities", kwargs=self.capabilities()),
+                   PRIORITY_CONTROL)
         if self.resend_requests:
             self._resend_requests()
 
+    def _setup_socket_buffers(self):
+        for option, size in ((socket.SO_SNDBUF, self.socket_sndbuf), (socket.SO_RCVBUF, self.socket_rcvbuf)):
+            if size:
+                try:
+                    self.socket.setsockopt(socket.SOL_SOCKET, option, size)
+                except (OSError, socket.error) as error:
+                    logger.warning("Can not set socket buffer size of {}: {}".format(self.addr, error))
+
+        self._send_buffer_size = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        self._recv_buffer_size = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        logger.debug("Socket buffers of {}: send {} bytes, receive {} bytes".format(
+            self.addr, self._send_buffer_size, self._recv_buffer_size))
+
+    def capabilities(self):
+        capabilities = {"binary_header": self.binary_header,
+                        "compression": ["zlib"],
+                        "file_chunks": True,
+                        }
+        if self.session_id is not None:
+            capabilities["session_id"] = self.session_id
+        capabilities.update(self.extra_capabilities)
+        return capabilities
+
+    @property
+    def use_binary_header(self):
+        return self.binary_header and self.peer_capabilities.get("binary_header", False)
+
+    @property
+    def message_options(self):
+        """Message creation options supported by the peer."""
+        compression = None
+        if self.compression_threshold and "zlib" in self.peer_capabilities.get("compression", ()):
+            compression = Compression(self.compression_threshold, self.compression_level)
+        return {"binary_header": self.use_binary_header, "compression": compression}
+
     def _clear(self):
         if not self.resume_queue:  # maybe needs locks
-            self._recv_buffer = b''
-            self._send_buffer = b''
+            self._recv_buffer.clear()
+            self._send_buffers.clear()
             self._received_queue.clear()
-            self._send_queue.clear()
+            self._clear_send_queues()
+
+        for receiver in self._file_receivers.values():
+            logger.warning("File {} transfer interrupted".format(receiver.filepath))
+            receiver.abort()
+        self._file_receivers.clear()
+
+    def _clear_send_queues(self):
+        with self._send_lock:
+            for queue in self._send_queues:
+                for _, item, _ in queue:
+                    if isinstance(item, FileStream):
+                        item.close()
+                queue.clear()
+            self._queued_messages = len(self._send_buffers)
+            self._queued_bytes = sum(len(buffer) for buffer in self._send_buffers)
+
+    @property
+    def send_queue_depth(self):
+        """Amount of messages and bytes waiting to be sent."""
+        return self._queued_messages, self._queued_bytes
+
+    @staticmethod
+    def _queued_size(item):
+        # file streams hold one chunk in memory at a time
+        return item.chunk_size if isinstance(item, FileStream) else len(item)
+
+    def _queue_full(self, size):
+        """Check limits for message of size, byte limit is not checked if size is None."""
+        return (self._queued_messages + 1 > self.send_queue_messages or
+                size is not None and self._queued_bytes + size > self.send_queue_bytes)
+
+    def _make_room(self, priority, size, droppable):
+        """Apply queue policy of priority class until message of size fits. Must be called with send lock acquired.
+
+        Returns True if message can be queued.
+        """
+        policy = self.queue_policies.get(priority, POLICY_FAIL)
+        if policy == POLICY_DROP_OLDEST:
+            queue = self._send_queues[priority]
+            kept = []
+            while self._queue_full(size) and queue:
+                entry = queue.popleft()
+                _, dropped, dropped_droppable = entry
+                if not dropped_droppable:
+                    kept.append(entry)
+                    continue
+                self._queued_messages -= 1
+                self._queued_bytes -= self._queued_size(dropped)
+                self.messages_dropped += 1
+                logger.debug("Dropped oldest {} message queued for {}".format(PRIORITY_NAMES[priority], self.addr))
+            queue.extendleft(reversed(kept))
+            if not droppable:  # requests and responses are never dropped, they exceed the limit instead
+                return True
+        return not self._queue_full(size)
 
     def close(self):
         with self._close_lock:
             self._should_close = True
 
         self._set_selector_events_mask('w')
-        NotifierSock().notify()
+        self._wakeup()
 
     def _close(self):
-        logger.info("Closing connection to {}".format(self.addr))
+        logger.info("Closing connection to {}: {}, {}".format(self.addr, self.io_stats, self.queue_delays))
 
         try:
             logger.info("Unregistering selector of {}".format(self.addr))
@@ -339,35 +938,41 @@ class ConnectionManager(object):
 
     def read(self):
         self._read()
+        self._process_recv_buffer()
+
+    def _process_recv_buffer(self):
         while self._recv_buffer:
             # add new message object if queue is empty or last message already processed
-            if not self._received_queue or (self._received_queue[0].content is not None):
-                self._received_queue.appendleft(MessageManager())
+            if not self._received_queue:
+                self._received_queue.append(MessageManager())
 
             last_message = self._received_queue[0]
+            last_message.process_message(self._recv_buffer)
 
-            last_message.income_raw += self._recv_buffer
-            self._recv_buffer = b''
-            last_message.process_message()
-
-            # if something left after processing message - put it back
-            if last_message.content is not None and last_message.income_raw:
-                self._recv_buffer = last_message.income_raw + self._recv_buffer
-                last_message.income_raw = b''
+            if last_message.content is None:
+                break  # wait for the rest of the message
 
-            if self._received_queue and last_message.content is not None:
-                self.process_received(self._received_queue.popleft())
+            self.process_received(self._received_queue.popleft())
 
     def _read(self):
+        size = max(self._recv_size, self.buffer_size)
         try:
-            data = self.socket.recv(self.buffer_size)
+            received = self.socket.recv_into(self._recv_buffer.write_view(size))
         except io.BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-                logger.debug("Received {} bytes from {}".format(len(data), self.addr))
+            self.io_stats.recv_calls += 1
+            self.io_stats.recv_bytes += received
+            # grow toward kernel buffer size while backlog fills whole reads, shrink back when idle
+            if received == size:
+                self._recv_size = min(size * 2, max(self._recv_buffer_size, self.buffer_size))
+            elif received < size // 4:
+                self._recv_size = max(size // 2, self.buffer_size)
+
+            if received:
+                self._recv_buffer.commit(received)
+                logger.debug("Received {} bytes from {}".format(received, self.addr))
             else:
                 logger.warning("Connection to {} lost!".format(self.addr))
 
@@ -388,19 +993,33 @@ class ConnectionManager(object):
             self._process_request(message)
 
     def _process_message(self, message):
-        if message.jsonheader["action"] == "filetransfer":
+        action = message.jsonheader["action"]
+        if action == "capabilities":
+            self.peer_capabilities = dict(message.content["kwargs"])
+            logger.info("Capabilities of {}: {}".format(self.addr, self.peer_capabilities))
+        elif action == "filechunk":
+            self._process_filechunk(message)
+        elif action == "filetransfer":
             self._process_filetransfer(message.content, message.jsonheader["filepath"])
         else:
             self._process_action(message)
 
     def _process_action(self, message):
-        action = message.jsonheader["action"]
-        args = message.content["args"]
-        kwargs = message.content["kwargs"]
+        self.run_action(message.jsonheader["action"], message.content["args"], message.content["kwargs"])
+
+    def run_action(self, action, args=(), kwargs=None):
+        """Run handler of action inline or in handler pool. Returns False if there is no such handler."""
         callback = self.messages_callbacks.get(action, None)
         if callback is None:
             logger.warning("Action {} does not exist!".format(action))
-            return
+            return False
+        if getattr(callback, "pooled", False):
+            self.handler_pool.submit(action, self._call_action, callback, action, args, kwargs or {})
+        else:
+            self._call_action(callback, action, args, kwargs or {})
+        return True
+
+    def _call_action(self, callback, action, args, kwargs):
         try:
             callback(self, *args, **kwargs)
         except Exception as error:
@@ -413,21 +1032,27 @@ class ConnectionManager(object):
         args = message.content["args"]
         kwargs = message.content["kwargs"]
 
-        filetransfer = requested_value == "filetransfer"
-        try:
-            if filetransfer:
-                value = self._read_file(kwargs["filepath"])
-            else:
-                callback = self.requests_callbacks.get(requested_value, None)
-                if callback is None:
-                    logger.warning("Request {} does not exist!".format(requested_value))
-                    return
+        if requested_value == "filetransfer":
+            self._send_file_stream(kwargs["filepath"], request_id=request_id)
+            return
+
+        callback = self.requests_callbacks.get(requested_value, None)
+        if callback is None:
+            logger.warning("Request {} does not exist!".format(requested_value))
+            return
+        if getattr(callback, "pooled", False):
+            self.handler_pool.submit(requested_value, self._answer_request, callback, requested_value, request_id,
+                                     args, kwargs)
+        else:
+            self._answer_request(callback, requested_value, request_id, args, kwargs)
 
-                value = callback(self, *args, **kwargs)
+    def _answer_request(self, callback, requested_value, request_id, args, kwargs):
+        try:
+            value = callback(self, *args, **kwargs)
         except Exception as error:  # TODO send response error\cancel
             logger.error("Error during request {} processing: {}".format(requested_value, error))
         else:
-            self._send_response(requested_value, request_id, value, filetransfer)
+            self._send_response(requested_value, request_id, value)
 
     def _process_response(self, message):
         request_id, requested_value = message.jsonheader["request_id"], message.jsonheader["requested_value"]
@@ -449,6 +1074,45 @@ class ConnectionManager(object):
             logger.debug(
                 "Request {} successfully closed with value {}".format(request, message.content["value"])
             )
+        self._call_request_callback(request, value)
+
+    def _refresh_request(self, request_id, request):
+        """Push back request deadline, must be called with request lock acquired."""
+        if request.timeout:
+            request.expires_on = monotonic() + request.timeout
+            heapq.heappush(self._request_deadlines, (request.expires_on, request_id))
+
+    @property
+    def requests_outstanding(self):
+        return len(self._request_queue)
+
+    def expire_requests(self, now=None):
+        """Drop requests which deadlines have passed and call their timeout callbacks."""
+        if now is None:
+            now = monotonic()
+
+        expired = []
+        with self._request_lock:
+            while self._request_deadlines and self._request_deadlines[0][0] <= now:
+                expires_on, request_id = heapq.heappop(self._request_deadlines)
+                request = self._request_queue.get(request_id, None)
+                # skip entries of answered requests and of requests with pushed back deadline
+                if request is not None and request.expires_on == expires_on:
+                    del self._request_queue[request_id]
+                    expired.append(request)
+            self.requests_expired += len(expired)
+
+        for request in expired:
+            logger.warning("Request {} to {} timed out ({} outstanding, {} expired)".format(
+                request.requested_value, self.addr, self.requests_outstanding, self.requests_expired))
+            if request.timeout_callback is not None:
+                try:
+                    request.timeout_callback(self, *request.callback_args, **request.callback_kwargs)
+                except Exception as error:
+                    logger.error("Error during request {} timeout processing: {}".format(request, error))
+        return len(expired)
+
+    def _call_request_callback(self, request, value):
         if request.callback is not None:
             try:
                 request.callback(self, value, *request.callback_args, **request.callback_kwargs)
@@ -457,10 +1121,64 @@ class ConnectionManager(object):
         else:
             logger.info("No callback were registered for response: {}".format(request))
 
-    @staticmethod
-    def _read_file(filepath):
-        with open(filepath, mode='rb') as f:
-            return f.read()
+    def _process_filechunk(self, message):
+        header = message.jsonheader
+        transfer_id = header["transfer_id"]
+        receiver = self._file_receivers.get(transfer_id, None)
+
+        if receiver is None:
+            request, filepath = None, header["filepath"]
+            request_id = header.get("request_id", None)
+            if request_id is not None:
+                with self._request_lock:
+                    request = self._request_queue.get(request_id, None)
+                if request is None:
+                    logger.warning("Unexpected file chunk for request {}!".format(request_id))
+                    return
+                filepath = request.callback_kwargs["filepath"]
+
+            try:
+                receiver = FileReceiver(filepath, header["total_length"], request)
+            except (OSError, IOError) as error:
+                logger.error("File {} can not be written due error: {}".format(filepath, error))
+                return
+            self._file_receivers[transfer_id] = receiver
+
+        try:
+            receiver.write(header["offset"], message.content)
+            if receiver.complete:
+                receiver.finish()
+        except (OSError, IOError, ValueError) as error:
+            logger.error("File {} can not be written due error: {}".format(receiver.filepath, error))
+            receiver.abort()
+            self._file_receivers.pop(transfer_id)
+            return
+
+        self._transfer_progress(receiver.filepath, receiver.received, receiver.size)
+        if not receiver.complete:
+            if receiver.request is not None:  # transfer in progress is not timed out
+                with self._request_lock:
+                    if header["request_id"] in self._request_queue:
+                        self._refresh_request(header["request_id"], receiver.request)
+            return
+
+        self._file_receivers.pop(transfer_id)
+        logger.info("File {} successfully received ".format(receiver.filepath))
+        self._file_received(receiver.filepath)
+
+        if receiver.request is not None:
+            with self._request_lock:
+                request = self._request_queue.pop(header["request_id"], None)
+            if request is not None:
+                self._call_request_callback(request, True)
+
+    def _transfer_progress(self, filepath, transferred, total):
+        logger.debug("File {} transfer progress: {}/{} bytes".format(filepath, transferred, total))
+
+    def _file_received(self, filepath):
+        if self.whoami == "pi":
+            logger.info("Return rights to pi:pi after file transfer")
+            os.system("chown pi:pi {}".format(filepath))
 
     def _process_filetransfer(self, content, filepath):
         try:
@@ -470,69 +1188,207 @@ class ConnectionManager(object):
             logger.error("File {} can not be written due error: {}".format(filepath, error))
         else:
             logger.info("File {} successfully received ".format(filepath))
-            if self.whoami == "pi":
-                logger.info("Return rights to pi:pi after file transfer")
-                os.system("chown pi:pi {}".format(filepath))
+            self._file_received(filepath)
+
+    def _next_chunk(self, stream):
+        """Return next chunk message of stream or None if file can not be read, then the stream is finished."""
+        try:
+            return stream.next_message(**self.message_options)
+        except (OSError, IOError) as error:
+            logger.error("File {} can not be sent due error: {}".format(stream.filepath, error))
+            stream.finished = True
+            return None
 
     def write(self):
+        streams = []
+        now = monotonic()
         with self._send_lock:
-            if (not self._send_buffer) and self._send_queue:
-                message = self._send_queue.popleft()
-                self._send_buffer += message
-        if self._send_buffer:
+            # only commands are added while previous data is not sent yet, so they wait for one chunk at most
+            # and other messages stay in queues where queue policies can be applied to them
+            backlog = bool(self._send_buffers)
+            for priority, queue in enumerate(self._send_queues):
+                if priority != PRIORITY_CONTROL and backlog:
+                    break
+                # coalesce everything queued; file stream at the head of the queue gives one chunk per pass,
+                # other streams wait for it to finish with their files closed and messages queued after
+                # a stream wait as well, so peer handles them when the file is received
+                waiting = []
+                stream_sent = False
+                for _ in range(len(queue)):
+                    queued_on, message, droppable = queue.popleft()
+                    if waiting or (isinstance(message, FileStream) and stream_sent):
+                        waiting.append((queued_on, message, droppable))
+                        continue
+                    self.queue_delays.add(priority, now - queued_on)
+                    if isinstance(message, FileStream):
+                        stream_sent = True
+                        stream, message = message, self._next_chunk(message)
+                        if stream.finished:
+                            stream.close()
+                            self._queued_messages -= 1
+                            self._queued_bytes -= stream.chunk_size
+                        else:
+                            waiting.append((now, stream, droppable))
+                        if message is None:  # file can not be read
+                            continue
+                        streams.append(stream)
+                        self._queued_messages += 1
+                        self._queued_bytes += len(message)
+                    self._send_buffers.append(memoryview(message))
+                queue.extend(waiting)
+        for stream in streams:
+            self._transfer_progress(stream.filepath, stream.offset, stream.size)
+
+        if self._send_buffers:
             self._write()
-        else:
-            self._set_selector_events_mask('r')  # we're done writing
+
+        with self._send_lock:
+            if self._writing and not (self._send_buffers or any(self._send_queues)):
+                self._writing = False
+                self._set_selector_events_mask('r')  # we're done writing
+
+    def _send_space(self):
+        """Return free space of socket send buffer in bytes."""
+        size = self._send_buffer_size
+        if fcntl is not None:
+            try:
+                queued = struct.unpack("i", fcntl.ioctl(self.socket, termios.TIOCOUTQ, b"\0" * 4))[0]
+            except (IOError, OSError):
+                pass
+            else:
+                size -= queued
+        return max(size, self.buffer_size)
 
     def _write(self):
+        space = self._send_space()
+        buffers = []
+        size = 0
+        for buffer in self._send_buffers:
+            if size >= space or len(buffers) >= 1024:  # IOV_MAX
+                break
+            buffers.append(buffer)
+            size += len(buffer)
+
         try:
-            sent = self.socket.send(self._send_buffer[:self.buffer_size])
+            if hasattr(self.socket, "sendmsg"):
+                sent = self.socket.sendmsg(buffers)
+            else:
+                sent = self.socket.send(b"".join(buffer.tobytes() for buffer in buffers))
         except io.BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         except Exception as error:
-            logger.warning(
-                "Attempt to send message {} to {} failed due error: {}".format(self._send_buffer, self.addr, error))
+            logger.warning("Attempt to send {} bytes to {} failed due error: {}".format(size, self.addr, error))
 
             raise error
         else:
-            self._send_buffer = self._send_buffer[sent:]
-            left = len(self._send_buffer)
-            logger.debug("Sent message to {}: sent {} bytes, {} bytes left.".format(self.addr, sent, left))
-
-    def _send(self, data):
+            self.io_stats.send_calls += 1
+            self.io_stats.send_bytes += sent
+            left, done = sent, 0
+            while left:
+                buffer = self._send_buffers[0]
+                if len(buffer) > left:
+                    self._send_buffers[0] = buffer[left:]
+                    break
+                self._send_buffers.popleft()
+                left -= len(buffer)
+                done += 1
+            with self._send_lock:
+                self._queued_messages -= done
+                self._queued_bytes -= sent
+            logger.debug("Sent {} messages to {}: sent {} bytes, {} messages left.".format(
+                len(buffers), self.addr, sent, len(self._send_buffers)))
+
+    def _send(self, data, priority=None, droppable=False, limit_bytes=True):
+        """Queue message or FileStream to send. Priority is one of PRIORITY_* classes,
+        by default files are sent as bulk data and messages as normal.
+        Droppable messages, such as telemetry, may be dropped by queue policy after they were queued.
+        Size of message queued with limit_bytes=False is not checked against send_queue_bytes.
+
+        Returns False if data was rejected by queue policy.
+        """
+        if priority is None:
+            priority = PRIORITY_BULK if isinstance(data, FileStream) else PRIORITY_NORMAL
+        size = self._queued_size(data)
         with self._send_lock:
-            self._send_queue.append(data)
-
-        if self.selector.get_key(self.socket).events != selectors.EVENT_WRITE:
+            if priority != PRIORITY_CONTROL and not self._make_room(priority, size if limit_bytes else None, droppable):
+                self.messages_dropped += 1
+                logger.warning("Send queue of {} is full ({} messages, {} bytes), {} message rejected".format(
+                    self.addr, self._queued_messages, self._queued_bytes, PRIORITY_NAMES[priority]))
+                return False
+            self._send_queues[priority].append((monotonic(), data, droppable))
+            self._queued_messages += 1
+            self._queued_bytes += size
+            if self._writing:
+                return True
+            self._writing = True
             self._set_selector_events_mask('rw')
-            NotifierSock().notify()
+        self._wakeup()
+        return True
 
-    def get_response(self, requested_value, callback,  # timeout=30,
+    def _wakeup(self):
+        if self._waker is not None:
+            self._waker.notify()
+
+    def get_response(self, requested_value, callback,
                      request_args=(), request_kwargs=None,
-                     callback_args=(), callback_kwargs=None, ):
+                     callback_args=(), callback_kwargs=None,
+                     timeout=None, timeout_callback=None, priority=None, ):
+        """Send request and call callback(connection, value, *callback_args, **callback_kwargs) on response.
+
+        Request is dropped if no response is received in timeout seconds (request_timeout by default),
+        timeout_callback(connection, *callback_args, **callback_kwargs) is called then.
+        Request sent with PRIORITY_BULK is handled by peer after files sent before it.
+        """
         if request_kwargs is None:
             request_kwargs = {}
         if callback_kwargs is None:
             callback_kwargs = {}
+        if timeout is None:
+            timeout = self.request_timeout
 
-        request_id = str(random.randint(0, 9999)).zfill(4)  # maybe hash
+        request_id = str(next(self._request_ids))
         with self._request_lock:
-            self._request_queue[request_id] = PendingRequest(
+            request = PendingRequest(
                 requested_value=requested_value,
                 value=None,
-                # expires_on=Server.time_now()+timeout, #TODO
+                timeout=timeout,
+                expires_on=None,
                 callback=callback,
                 callback_args=callback_args,
                 callback_kwargs=callback_kwargs,
+                timeout_callback=timeout_callback,
                 request_args=request_args,
                 request_kwargs=request_kwargs,
                 resend=True,
             )
-        self._send(MessageManager.create_request(requested_value, request_id, request_args, request_kwargs))
+            self._request_queue[request_id] = request
+            self._refresh_request(request_id, request)
+        self._send(MessageManager.create_request(requested_value, request_id, request_args, request_kwargs,
+                                                 **self.message_options), priority)
+
+    def request(self, requested_value, request_args=(), request_kwargs=None, timeout=None):
+        """Send request and return concurrent.futures.Future resolved with response value.
+
+        Future fails with futures.TimeoutError if no response is received in time.
+        """
+        future = futures.Future()
+
+        def on_response(_connection, value):
+            if not future.cancelled():
+                future.set_result(value)
+
+        def on_timeout(_connection):
+            if not future.cancelled():
+                future.set_exception(futures.TimeoutError("Request {} to {} timed out".format(
+                    requested_value, self.addr)))
+
+        self.get_response(requested_value, on_response, request_args, request_kwargs,
+                          timeout=timeout, timeout_callback=on_timeout)
+        return future
 
     def get_file(self, client_filepath, filepath=None, callback=None,
-                 callback_args=(), callback_kwargs=None, ):
+                 callback_args=(), callback_kwargs=None, timeout=None, timeout_callback=None, ):
         if callback_kwargs is None:
             callback_kwargs = {}
 
@@ -543,83 +1399,118 @@ class ConnectionManager(object):
         callback_kwargs.update({"filepath": filepath})
 
         self.get_response("filetransfer", callback, request_kwargs=request_kwargs,
-                          callback_args=callback_args, callback_kwargs=callback_kwargs)
+                          callback_args=callback_args, callback_kwargs=callback_kwargs,
+                          timeout=timeout, timeout_callback=timeout_callback)
 
     def _resend_requests(self):
         with self._request_lock:
             for request_id, request in self._request_queue.items():  # TODO filter
                 if request.resend:
                     self._send(MessageManager.create_request(
-                        request.requested_value, request_id, request.request_kwargs.update(resend=request.resend))
+                        request.requested_value, request_id, request.request_args, request.request_kwargs,
+                        **self.message_options)
                     )
                     request.resend = False
 
-    def send_message(self, action, args=(), kwargs=None):
-        self._send(MessageManager.create_action_message(action, args, kwargs))
+    def send_message(self, action, args=(), kwargs=None, priority=PRIORITY_CONTROL, droppable=False):
+        self._send(MessageManager.create_action_message(action, args, kwargs, **self.message_options),
+                   priority, droppable)
 
     def _send_response(self, requested_value, request_id, value, filetransfer=False):
-        self._send(MessageManager.create_response(requested_value, request_id, value, filetransfer))
+        self._send(MessageManager.create_response(requested_value, request_id, value, filetransfer,
+                                                  **self.message_options))
 
     def send_file(self, filepath, dest_filepath):  # clever_restart=False
+        logger.info("Sending file {} to {} (as: {})".format(filepath, self.addr, dest_filepath))
+        self._send_file_stream(filepath, dest_filepath=dest_filepath)
+
+    def _send_file_stream(self, filepath, dest_filepath=None, request_id=None):
+        if not self.peer_capabilities.get("file_chunks", False):
+            self._send_whole_file(filepath, dest_filepath, request_id)
+            return
+        try:
+            stream = FileStream(filepath, next(self._transfer_ids), dest_filepath, request_id)
+        except (OSError, IOError, ValueError) as error:
+            logger.warning("File {} can not be opened due error: {}".format(filepath, error))
+        else:
+            if not self._send(stream):
+                stream.close()
+
+
+    def _send_whole_file(self, filepath, dest_filepath=None, request_id=None):
+        """Send file as single 'filetransfer' message to peers not supporting file chunks."""
         try:
             with open(filepath, 'rb') as f:
                 data = f.read()
-        except OSError as error:
-            logger.warning("File can not be opened due error: ".format(error))
+        except (OSError, IOError) as error:
+            logger.warning("File {} can not be opened due error: {}".format(filepath, error))
+            return
+        if request_id is not None:
+            message = MessageManager.create_response("filetransfer", request_id, data, True, **self.message_options)
         else:
-            logger.info("Sending file {} to {} (as: {})".format(filepath, self.addr, dest_filepath))
-            self._send(MessageManager.create_message(data, "binary", "message",
-                       additional_headers={"action": "filetransfer", "filepath": dest_filepath}))
-
+            message = MessageManager.create_message(data, "binary", "message",
+                                                    additional_headers={"action": "filetransfer",
+                                                                        "filepath": dest_filepath},
+                                                    **self.message_options)
+        # whole file can not fit into byte limit of send queue, which is meant for file chunks
+        self._send(message, PRIORITY_BULK, limit_bytes=False)
 
-class NotifierSock(Singleton):
-    def __init__(self):
-        self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        self._server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        self._sending_sock = socket.socket()
-        self._send_lock = threading.Lock()
+class SelectorWaker(object):
+    """Wakes up thread waiting in selector when other threads change connections state.
 
-        self._receiving_sock = None
+    Wakeups are coalesced: only one byte is in flight until selector thread drains it.
+    """
+    _wakers = weakref.WeakKeyDictionary()  # selector: waker
 
-    def init(self, selector, port=26000):
-        port += random.randint(0, 100)  # local testing fix
+    def __init__(self, selector):
+        self.selector = selector
+        self._receiving_sock, self._sending_sock = socket.socketpair()
+        self._receiving_sock.setblocking(False)
+        self._sending_sock.setblocking(False)
 
-        self._server_socket.bind(('', port))
-        self._server_socket.listen(1)
-        self._sending_sock.connect(('127.0.0.1', port))
-        self._receiving_sock, _ = self._server_socket.accept()
-        logger.info("Notify socket: connected")
+        self._pending = False
+        self._lock = threading.Lock()
 
         selector.register(self._receiving_sock, selectors.EVENT_READ, data=self)
-        logger.info("Notify socket: selector registered")
+        self._wakers[selector] = self
 
-    def get_sock(self):
-        return self._receiving_sock
+    @classmethod
+    def get(cls, selector):
+        """Return waker registered for selector or None."""
+        return cls._wakers.get(selector, None)
+
+    def fileno(self):
+        return self._receiving_sock.fileno()
 
     def notify(self):
-        with self._send_lock:
-            if self._receiving_sock is None:
+        with self._lock:
+            if self._pending:
                 return
-            self._sending_sock.sendall(bytes(1))
-            logger.debug("Notify socket: notified")
+            self._pending = True
+        try:
+            self._sending_sock.send(b"\0")
+            logger.debug("Selector waker: notified")
+        except (io.BlockingIOError, socket.error):  # full or closed pair, selector is woken up anyway
+            pass
 
     def process_events(self, mask):
-        if mask & selectors.EVENT_READ and self._receiving_sock is not None:
+        if mask & selectors.EVENT_READ:
             try:
-                self._receiving_sock.recv(1024)
-                logger.debug("Notify socket: received")
-            except io.BlockingIOError:
+                while self._receiving_sock.recv(1024):
+                    pass
+            except (io.BlockingIOError, socket.error):
                 pass
-            except Exception as e:
-                logger.error(e)
+            # reset after draining: a notification made meanwhile is handled by the caller processing
+            # connections after this call, while reset before draining could swallow the byte of next one
+            with self._lock:
+                self._pending = False
 
     def close(self):
+        self._wakers.pop(self.selector, None)
         try:
-            self._server_socket.close()
-            self._sending_sock.close()
-            self._receiving_sock.close()
-        except (OSError, KeyError) as error:
-            logger.error("Error during unregistring notifier socket: {}".format(error))
+            self.selector.unregister(self._receiving_sock)
+        except (KeyError, ValueError, RuntimeError, AttributeError):  # selector already closed
+            pass
+        self._receiving_sock.close()
+        self._sending_sock.close()
@@ -0,0 +1,126 @@
+"""ConnectionManager transport for asyncio event loops (Python 3 only).
+
+Messages, requests and send queues are handled by messaging.ConnectionManager;
+socket reads and writes are replaced by asyncio transport callbacks, so callbacks run on the event loop thread
+and no selector thread or waker is needed.
+"""
+import asyncio
+import logging
+
+import messaging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioConnection(messaging.ConnectionManager):
+    """ConnectionManager fed by asyncio transport instead of selector events.
+
+    Call connect_transport() from connection_made of protocol and pass other protocol callbacks through.
+    Sending is thread safe: data queued from other threads is written on the event loop.
+    """
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+        self.transport = None
+        self._writing_paused = False
+
+    def connect_transport(self, loop, transport, addr):
+        self.loop = loop
+        self.transport = transport
+        self._writing_paused = False
+        self.connect(None, transport.get_extra_info('socket'), addr)
+
+    def _set_selector_events_mask(self, mode):
+        pass  # transport reads all the time, writing is scheduled by _wakeup
+
+    def _wakeup(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.write)
+
+    def data_received(self, data):
+        self.io_stats.recv_calls += 1
+        self.io_stats.recv_bytes += len(data)
+        self._recv_buffer.extend(data)
+        self._process_recv_buffer()
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self.write()
+
+    def connection_lost(self, exc):
+        logger.warning("Connection to {} lost{}".format(self.addr, ": {}".format(exc) if exc else "!"))
+        self.transport = None
+        self._close()
+
+    def write(self):
+        if self.transport is None or self._writing_paused:
+            return  # continued by resume_writing
+        super().write()
+        with self._send_lock:
+            more = self._writing
+        if more and not self._writing_paused:  # file streams give one chunk per pass
+            self.loop.call_soon(self.write)
+
+    def _send_space(self):
+        return max(self.transport.get_write_buffer_limits()[1] - self.transport.get_write_buffer_size(),
+                   self.buffer_size)
+
+    def _write(self):
+        space = self._send_space()
+        buffers = []
+        size = 0
+        while self._send_buffers and size < space:
+            buffer = self._send_buffers.popleft()
+            buffers.append(buffer)
+            size += len(buffer)
+
+        self.transport.writelines(buffers)  # transport copies data it can not send at once
+        self.io_stats.send_calls += 1
+        self.io_stats.send_bytes += size
+        with self._send_lock:
+            self._queued_messages -= len(buffers)
+            self._queued_bytes -= size
+        logger.debug("Sent {} messages to {}: sent {} bytes, {} messages left.".format(
+            len(buffers), self.addr, size, len(self._send_buffers)))
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        logger.info("Closing connection to {}: {}, {}".format(self.addr, self.io_stats, self.queue_delays))
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self.socket = None
+
+        with self._close_lock:
+            self._should_close = False
+
+        self._clear()
+        logger.info("CLOSED connection to {}".format(self.addr))
+
+
+class ConnectionProtocol(asyncio.Protocol):
+    """Protocol passing transport events of single connection to AsyncioConnection."""
+    def __init__(self, connection):
+        self.connection = connection
+
+    def connection_made(self, transport):
+        self.connection.connect_transport(asyncio.get_event_loop(), transport,
+                                          transport.get_extra_info('peername'))
+
+    def data_received(self, data):
+        self.connection.data_received(data)
+
+    def pause_writing(self):
+        self.connection.pause_writing()
+
+    def resume_writing(self):
+        self.connection.resume_writing()
+
+    def connection_lost(self, exc):
+        self.connection.connection_lost(exc)
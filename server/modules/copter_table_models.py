@@ -3,7 +3,6 @@ import re
 import sys
 import math
 import time
-import subprocess
 from contextlib import suppress
 from functools import partialmethod
 
@@ -11,19 +10,13 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt as Qt, QUrl, QDir
 
 from config import ConfigManager
+from git_version import get_git_version
 
 # Additional custom roles to interact with various table data
 ModelDataRole = 998
 ModelStateRole = 999
 
 
-def get_git_version():  # TODO import from animation
-    try:
-        return subprocess.check_output("git log --pretty=format:'%h' -n 1", shell=True).decode('UTF-8')
-    except subprocess.CalledProcessError:  # when no git repository info present
-        return None  # todo probably add special file
-
-
 class CheckState:
     def __init__(self, bool_state, color):
         self._bool = bool_state
@@ -50,6 +43,8 @@ class ModelChecks:
     time_delta_max = 1.0
     check_current_pos = True
     check_git = True
+    send_queue_max = 65536
+    clock_uncertainty_max = 0.01
 
     @classmethod
     def column_check(cls, column, pass_context=False):
@@ -142,6 +137,20 @@ def check_time_delta(item):
     return abs(item) < ModelChecks.time_delta_max
 
 
+@ModelChecks.column_check("send_queue")
+def check_send_queue(item):
+    if ModelChecks.send_queue_max == 0:
+        return True
+    return item[1] <= ModelChecks.send_queue_max
+
+
+@ModelChecks.column_check("clock_sync")
+def check_clock_sync(item):
+    if ModelChecks.clock_uncertainty_max == 0:
+        return True
+    return item[1] <= ModelChecks.clock_uncertainty_max
+
+
 @ModelChecks.column_check("start_position", pass_context=True)
 def check_start_pos(item, context):
 
@@ -220,6 +229,14 @@ class StatedCopterData(CopterData):
                     self.checks.check(key, self)
                 self.states.__dict__["all_checks"] = all([self.states[i] for i in self.checks.checks_dict.keys()])
 
+    def update(self, values):
+        """Set several columns at once; checks see all new values and all_checks is computed once."""
+        self.__dict__.update(values)
+        for key in values:
+            with suppress(KeyError):
+                self.states.__dict__[key] = self.checks.check(key, self)
+        self.states.__dict__["all_checks"] = all([self.states[i] for i in self.checks.checks_dict.keys()])
+
 
 class ModelFormatter:
     view_formatters = {}
@@ -358,6 +375,31 @@ def view_time_delta(value):
     return f"{value:.3f}"
 
 
+@ModelFormatter.view_formatter("send_queue")
+def view_send_queue(value):
+    messages, size = value
+    return f"{messages} / {size / 1024:.0f}K"
+
+
+@ModelFormatter.view_formatter("clock_sync")
+def view_clock_sync(value):
+    offset, uncertainty, age = value
+    return f"{offset * 1000:+.1f}±{uncertainty * 1000:.1f}ms {age:.0f}s"
+
+
+@ModelFormatter.view_formatter("clock_estimate")
+def view_clock_estimate(value):
+    offset, delay = value
+    return f"{offset * 1000:+.1f} / {delay * 1000:.1f}ms"
+
+
+@ModelFormatter.view_formatter("start_status")
+def view_start_status(value):
+    if value[0] == "armed":
+        return f"armed: {value[1]} tasks"
+    return ": ".join(str(item) for item in value)
+
+
 class CopterDataModel(QtCore.QAbstractTableModel):
     columns_dict = {'copter_id': 'copter ID',
                     'git_version': 'version',
@@ -372,9 +414,14 @@ class CopterDataModel(QtCore.QAbstractTableModel):
                     'start_position': 'start x y z yaw action delay',
                     'last_task': 'last task',
                     'time_delta': 'dt',
+                    'send_queue': 'queue',
+                    'clock_sync': 'clock',
+                    'clock_estimate': 'offset / delay',
+                    'start_status': 'start',
                     }
 
     columns = list(columns_dict.keys())
+    column_indexes = dict(zip(columns, range(len(columns))))
 
     selected_ready_signal = QtCore.pyqtSignal(bool)
     selected_takeoff_ready_signal = QtCore.pyqtSignal(bool)
@@ -383,6 +430,7 @@ class CopterDataModel(QtCore.QAbstractTableModel):
     selected_calibration_ready_signal = QtCore.pyqtSignal(bool)
 
     update_data_signal = QtCore.pyqtSignal(int, int, QtCore.QVariant, QtCore.QVariant)
+    update_row_signal = QtCore.pyqtSignal(object, dict)
     add_client_signal = QtCore.pyqtSignal(object)
     remove_row_signal = QtCore.pyqtSignal(int)
     remove_client_signal = QtCore.pyqtSignal(object)
@@ -391,12 +439,14 @@ class CopterDataModel(QtCore.QAbstractTableModel):
         super(CopterDataModel, self).__init__(parent)
         self.headers = list(self.columns_dict.values())
         self.data_contents = []
+        self._client_rows = {}  # client: row index
 
         self.checks = checks
         self.formatter = formatter
         self.data_model = data_model
 
         self.update_data_signal.connect(self._update_data)
+        self.update_row_signal.connect(self._update_row)
         self.add_client_signal.connect(self._add_client)
         self.remove_row_signal.connect(self._remove_row)
         self.remove_client_signal.connect(self._remove_row_data)
@@ -406,12 +456,16 @@ class CopterDataModel(QtCore.QAbstractTableModel):
         position = len(self.data_contents) if position == 'last' else position
         self.beginInsertRows(parent, position, position + rows - 1)
         self.data_contents[position:position] = contents
+        self._index_rows(position)
 
         self.endInsertRows()
 
     def removeRows(self, position, rows=1, index=QtCore.QModelIndex()):
         self.beginRemoveRows(QtCore.QModelIndex(), position, position + rows - 1)
+        for row_data in self.data_contents[position:position + rows]:
+            self._client_rows.pop(getattr(row_data, "client", None), None)
         self.data_contents = self.data_contents[:position] + self.data_contents[position + rows:]
+        self._index_rows(position)
         self.endRemoveRows()
         self.emit_signals()
         return True
@@ -446,6 +500,17 @@ class CopterDataModel(QtCore.QAbstractTableModel):
         except ValueError:
             return None
 
+    def _index_rows(self, position=0):
+        for row in range(position, len(self.data_contents)):
+            self._client_rows[getattr(self.data_contents[row], "client", None)] = row
+
+    def get_client_row(self, client):
+        return self._client_rows.get(client, None)
+
+    def get_row_by_client(self, client):
+        row = self._client_rows.get(client, None)
+        return self.data_contents[row] if row is not None else None
+
     def get_row_by_attr(self, attr, value):
         try:
             return next(filter(lambda x: getattr(x, attr, None) == value, self.data_contents))
@@ -602,10 +667,36 @@ class CopterDataModel(QtCore.QAbstractTableModel):
     def update_data(self, row, col, data, role=ModelDataRole):
         self.update_data_signal.emit(row, col, data, role)
 
+    def update_row(self, client, values):
+        """Set values of several columns of client row, place formatters are applied."""
+        self.update_row_signal.emit(client, values)
+
     @QtCore.pyqtSlot(int, int, QtCore.QVariant, QtCore.QVariant)
     def _update_data(self, row, col, value, role=Qt.EditRole):
         self.setData(self.index(row, col), value, role)
 
+    @QtCore.pyqtSlot(object, dict)
+    def _update_row(self, client, values):
+        row = self._client_rows.get(client, None)
+        if row is None:
+            return
+
+        formatted_values = {}
+        for column, value in values.items():
+            if column in self.column_indexes:
+                formatted_value = self.formatter.format_place(column, value)
+                if formatted_value is not None:
+                    formatted_values[column] = formatted_value
+        if not formatted_values:
+            return
+
+        row_data = self.data_contents[row]
+        row_data.update(formatted_values)
+        if row_data.states.checked == Qt.Checked:  # signals depend on selected rows only
+            self.emit_signals()
+        cols = [self.column_indexes[column] for column in formatted_values]
+        self.dataChanged.emit(self.index(row, min(cols)), self.index(row, max(cols)))
+
     @QtCore.pyqtSlot(object)
     def _add_client(self, client):
         self.insertRows([client])
@@ -2,10 +2,12 @@ import os
 import sys
 import time
 import socket
+import asyncio
 import random
 import logging
 import datetime
 import threading
+import itertools
 import selectors
 import collections
 import traceback
@@ -17,6 +19,8 @@ sys.path.insert(0, lib_dir)
 
 # Import modules from lib dir
 import messaging
+from messaging_asyncio import AsyncioConnection
+from clock_sync import ClockSync, ExchangeFilter
 from config import ConfigManager
 
 random.seed()
@@ -37,6 +41,206 @@ logger = logging.getLogger(__name__)
 ConfigOption = collections.namedtuple("ConfigOption", ["section", "option", "value"])
 
 
+class PendingCommand(messaging.Namespace): pass
+
+
+class FleetStart(messaging.Namespace):
+    """Start of animation on several copters, tracked until all of them are armed or deadline passes."""
+    @property
+    def waiting(self):
+        return [client for client in self.clients if client not in self.armed and client not in self.failed]
+
+    @property
+    def complete(self):
+        return len(self.armed) + len(self.failed) == len(self.clients)
+
+
+def parse_handshake(data, limit):
+    """Parse first message received from copter on connect.
+
+    Returns (complete, session_id): complete is False while message is not received completely.
+    """
+    message = messaging.MessageManager()
+    try:
+        message.process_message(messaging.ReceiveBuffer.from_bytes(data))
+    except Exception as error:
+        logging.warning("Unexpected handshake message: {}".format(error))
+        return True, None
+
+    if message.content is None:
+        return len(data) >= limit, None  # too long for capabilities message
+    if message.jsonheader.get("action") == "capabilities":
+        return True, message.content["kwargs"].get("session_id", None)
+    return True, None
+
+
+class PendingConnection(object):
+    """Accepted connection waiting for copter to identify itself with session id of its capabilities message.
+
+    Data received meanwhile is processed by the client the connection is handed over to.
+    """
+    handshake_limit = 4096
+
+    def __init__(self, sock, addr, deadline, on_identified):
+        self.socket = sock
+        self.addr = addr
+        self.deadline = deadline
+        self.on_identified = on_identified
+        self.received = b""
+
+    def process_events(self, mask):
+        try:
+            data = self.socket.recv(self.handshake_limit - len(self.received))
+        except BlockingIOError:
+            return
+        except OSError as error:
+            logging.warning("Connection from {} lost during handshake: {}".format(self.addr, error))
+            data = b""
+
+        if not data:
+            self.on_identified(self, None, closed=True)
+            return
+
+        self.received += data
+        complete, session_id = parse_handshake(self.received, self.handshake_limit)
+        if complete:
+            self.on_identified(self, session_id)
+
+
+class ClientProtocol(asyncio.Protocol):
+    """Copter connection accepted on asyncio event loop, bound to its client when copter identifies itself."""
+    handshake_limit = PendingConnection.handshake_limit
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.addr = None
+        self.client = None
+        self._received = b""
+        self._handshake_timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        logging.info("Got connection from: {}".format(str(self.addr)))
+        self._handshake_timer = self.server.loop.call_later(self.server.config.server_handshake_timeout,
+                                                            self._handshake_timeout)
+
+    def data_received(self, data):
+        if self.client is None:
+            self._received += data
+            complete, session_id = parse_handshake(self._received, self.handshake_limit)
+            if complete:
+                self._identified(session_id)
+            return
+
+        try:
+            self.client.data_received(data)
+        except Exception as error:
+            logging.error("Exception {} occurred for {}! Resetting connection!".format(error, self.addr))
+            traceback.print_exc()
+            self.client.close(True)
+
+    def _handshake_timeout(self):
+        logging.info("Client {} did not identify itself, identifying by IP address".format(self.addr))
+        self._identified(None)
+
+    def _identified(self, session_id):
+        self._handshake_timer.cancel()
+        self.client = self.server.attach_transport(self, session_id)
+        data, self._received = self._received, b""
+        if data:
+            self.data_received(data)
+
+    def _bound(self):
+        return self.client is not None and self.client.transport is self.transport
+
+    def connection_lost(self, exc):
+        if self.client is None:
+            self._handshake_timer.cancel()
+            logging.info("Connection from {} closed during handshake".format(self.addr))
+        elif self._bound():  # otherwise client has already reconnected with other transport
+            self.client.connection_lost(exc)
+
+    def pause_writing(self):
+        if self._bound():
+            self.client.pause_writing()
+
+    def resume_writing(self):
+        if self._bound():
+            self.client.resume_writing()
+
+
+def process_client_events(client, mask):
+    try:
+        client.process_events(mask)
+    except Exception as error:
+        logging.error("Exception {} occurred for {}! Resetting connection!".format(error, client.addr))
+        traceback.print_exc()
+        client.close(True)
+
+
+def attach_client(sel, client, conn, addr, reconnect, received=b""):
+    if reconnect:
+        client.close(True)  # to ensure in unregistering
+    sel.register(conn, selectors.EVENT_READ, data=client)
+    client.connect(sel, conn, addr)
+    if received:  # read during handshake
+        try:
+            client.process_handshake_data(received)
+        except Exception as error:
+            logging.error("Exception {} occurred for {}! Resetting connection!".format(error, client.addr))
+            traceback.print_exc()
+            client.close(True)
+
+
+class ClientLoop(object):
+    """Selector thread serving a share of client connections, used when server runs several of them."""
+    def __init__(self, name):
+        self.sel = selectors.DefaultSelector()
+        self.waker = messaging.SelectorWaker(self.sel)
+        self.clients = set()
+        # (client, socket, address, reconnect, received) handed over by accept thread
+        self._attaching = collections.deque()
+
+        self.thread = threading.Thread(target=self._process, daemon=True, name=name)
+        self.running = threading.Event()
+
+    def start(self):
+        self.running.set()
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.waker.notify()
+        self.thread.join(timeout=2)
+        self.waker.close()
+        self.sel.close()
+
+    def attach(self, client, conn, addr, reconnect, received=b""):
+        """Hand over connection of client to this loop, may be called from any thread."""
+        self._attaching.append((client, conn, addr, reconnect, received))
+        self.waker.notify()
+
+    def _process(self):
+        logging.info("Client loop (selector) thread started!")
+        while self.running.is_set():
+            for key, mask in self.sel.select(timeout=1):
+                if isinstance(key.data, messaging.ConnectionManager):
+                    process_client_events(key.data, mask)
+                else:  # SelectorWaker
+                    key.data.process_events(mask)
+
+            while self._attaching:
+                client, conn, addr, reconnect, received = self._attaching.popleft()
+                self.clients.add(client)
+                attach_client(self.sel, client, conn, addr, reconnect, received)
+
+            for client in list(self.clients):
+                client.run_timers()
+        logging.info("Client loop thread stopped!")
+
+
 class Server(messaging.Singleton):
     def __init__(self, config_path="../config/server.ini", server_id=None):
         self.id = server_id if server_id else str(random.randint(0, 9999)).zfill(4)
@@ -44,6 +248,7 @@ class Server(messaging.Singleton):
 
         # Init socket
         self.sel = selectors.DefaultSelector()
+        self.waker = messaging.SelectorWaker(self.sel)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         messaging.set_keepalive(self.server_socket)
@@ -70,6 +275,28 @@ class Server(messaging.Singleton):
                                                 name='IP broadcast listener')
         self.listener_thread_running = threading.Event()
 
+        self._pending_connections = {}  # socket: PendingConnection
+        self.client_loops = []  # additional selector threads sharing client connections
+        self._next_loop = None
+
+        self.clock = None  # synchronized with NTP server if enabled
+
+        # Init asyncio transport
+        self.client_class = Client
+        self.loop = None
+        self._asyncio_server = None
+        self._expire_timer = None
+
+        # Init UDP command channel
+        self.command_socket = None
+        self._command_seq = itertools.count(1)
+        self._pending_commands = {}
+        self._commands_lock = threading.Lock()
+
+        # Fleet starts waiting for acknowledgements
+        self._start_seq = itertools.count(1)
+        self._fleet_starts = {}
+
     def load_config(self):
         self.config.load_config_and_spec(self.config_path)
 
@@ -81,12 +308,18 @@ class Server(messaging.Singleton):
 
         logging.info("Starting server with id: {} on {}:{} ({})!".format(self.id, self.ip, self.config.server_port,
                                                                          socket.gethostname()))
+        if self.config.ntp_use:
+            self.clock = ClockSync(self.config.ntp_host, self.config.ntp_port, self.config.ntp_interval,
+                                   self.config.ntp_burst)
+            self.clock.start()
+
         logging.info("Binding server socket!")
         self.server_socket.bind((self.ip, self.config.server_port))
 
-        logging.info("Starting client processor thread!")
-        self.client_processor_thread_running.set()
-        self.autoconnect_thread.start()
+        if self.config.server_transport == "asyncio":
+            self._start_asyncio()
+        else:
+            self._start_threads()
 
         if self.config.broadcast_send:
             logging.info("Starting broadcast sender thread!")
@@ -98,9 +331,16 @@ class Server(messaging.Singleton):
             self.listener_thread_running.set()
             self.listener_thread.start()
 
+        if self.config.broadcast_commands:
+            logging.info("Opening UDP command socket!")
+            self.command_socket = self._create_command_socket()
+
     def stop(self):
         logging.info("Stopping server")
 
+        if self.clock is not None:
+            self.clock.stop()
+
         self.client_processor_thread_running.clear()
 
         self.broadcast_thread_interrupt.set()
@@ -108,40 +348,76 @@ class Server(messaging.Singleton):
 
         self.listener_thread_running.clear()
 
-        messaging.NotifierSock().notify()
+        self.waker.notify()
+        for client_loop in self.client_loops:
+            client_loop.stop()
+        if self._expire_timer is not None:
+            self._expire_timer.cancel()
+        if self._asyncio_server is not None:
+            if self._asyncio_server.done() and not self._asyncio_server.cancelled():
+                self._asyncio_server.result().close()
+            else:
+                self._asyncio_server.cancel()
 
         self.server_socket.close()
+        if self.command_socket is not None:
+            self.command_socket.close()
+            self.command_socket = None
+        self.waker.close()
         self.sel.close()
 
-        messaging.NotifierSock().close()
-
         logging.info("Server stopped")
 
     def terminate(self, reason="Terminated"):
         self.stop()
         logging.critical(reason)
 
-    @staticmethod
-    def get_ntp_time(ntp_host, ntp_port):
-        NTP_DELTA = 2208988800  # 1970-01-01 00:00:00
-        NTP_QUERY = b'\x1b' + bytes(47)
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ntp_socket:
-            ntp_socket.sendto(NTP_QUERY, (ntp_host, ntp_port))
-            msg, _ = ntp_socket.recvfrom(1024)
-        return int.from_bytes(msg[-8:], 'big') / 2 ** 32 - NTP_DELTA
-
     def time_now(self):
-        if self.config.ntp_use:
-            return self.get_ntp_time(self.config.ntp_host, self.config.ntp_port)
+        if self.clock is not None:
+            return self.clock.time_now()
 
         return time.time()
 
+    def _start_threads(self):
+        if self.config.server_selector_threads > 1:
+            logging.info("Starting {} client loop threads!".format(self.config.server_selector_threads))
+            self.client_loops = [ClientLoop('Client loop {}'.format(i))
+                                 for i in range(self.config.server_selector_threads)]
+            self._next_loop = itertools.cycle(self.client_loops)
+            for client_loop in self.client_loops:
+                client_loop.start()
+
+        logging.info("Starting client processor thread!")
+        self.client_processor_thread_running.set()
+        self.autoconnect_thread.start()
+
+    def _start_asyncio(self):
+        logging.info("Serving clients on asyncio event loop!")
+        self.loop = asyncio.get_event_loop()
+        self.client_class = AsyncioClient
+        self.server_socket.listen()
+        self.server_socket.setblocking(False)
+        self._asyncio_server = asyncio.ensure_future(
+            self.loop.create_server(lambda: ClientProtocol(self), sock=self.server_socket), loop=self.loop)
+        self._expire_timer = self.loop.call_soon(self._run_client_timers)
+
+    def _run_client_timers(self):
+        for client in list(Client.clients.values()):
+            client.run_timers()
+        self._expire_timer = self.loop.call_later(1, self._run_client_timers)
+
+    def attach_transport(self, protocol, session_id):
+        """Bind connection accepted on asyncio event loop to client, returns the client."""
+        client, reconnect = self._find_client(session_id, protocol.addr)
+        if reconnect:
+            client.close(True)
+        client.connect_transport(self.loop, protocol.transport, protocol.addr)
+        return client
+
     # noinspection PyArgumentList
     def _client_processor(self):
         logging.info("Client processor (selector) thread started!")
 
-        messaging.NotifierSock().init(self.sel)
-
         self.server_socket.listen()
         self.server_socket.setblocking(False)
         self.sel.register(self.server_socket, selectors.EVENT_READ, data=None)
@@ -153,15 +429,21 @@ class Server(messaging.Singleton):
                 if client is None:
                     self._connect_client(key.fileobj)
                 elif isinstance(client, messaging.ConnectionManager):
-                    try:
-                        client.process_events(mask)
-                    except Exception as error:
-                        logging.error("Exception {} occurred for {}! Resetting connection!".format(error, client.addr))
-                        traceback.print_exc()
-                        client.close(True)
-                else:  # Notifier
+                    process_client_events(client, mask)
+                else:  # SelectorWaker or PendingConnection
                     client.process_events(mask)
 
+            if not self.client_loops:
+                for client in list(Client.clients.values()):
+                    client.run_timers()
+
+            now = time.time()
+            for pending in list(self._pending_connections.values()):
+                if pending.deadline <= now:
+                    logging.info("Client {} did not identify itself, identifying by IP address".format(
+                        pending.addr))
+                    self._attach_client(pending, None)
+
         logging.info("Client autoconnect thread stopped!")
 
     def _connect_client(self, sock):
@@ -174,16 +456,68 @@ class Server(messaging.Singleton):
         logging.info("Got connection from: {}".format(str(addr)))
         conn.setblocking(False)
 
-        if not any([client_addr == addr[0] for client_addr in Client.clients.keys()]):
-            client = Client(addr[0])
+        # client is chosen when copter sends its session id, so copters behind one address are told apart
+        pending = PendingConnection(conn, addr, time.time() + self.config.server_handshake_timeout,
+                                    self._attach_client)
+        self._pending_connections[conn] = pending
+        self.sel.register(conn, selectors.EVENT_READ, data=pending)
+
+    def _attach_client(self, pending, session_id, closed=False):
+        self._pending_connections.pop(pending.socket, None)
+        self.sel.unregister(pending.socket)
+        if closed:
+            logging.info("Connection from {} closed during handshake".format(pending.addr))
+            pending.socket.close()
+            return
+
+        conn, addr = pending.socket, pending.addr
+        client, reconnect = self._find_client(session_id, addr)
+
+        if self.client_loops:
+            # client stays in the loop its socket was registered in, new clients are distributed round-robin
+            if client.client_loop is None:
+                client.client_loop = next(self._next_loop)
+            client.client_loop.attach(client, conn, addr, reconnect, pending.received)
+        else:
+            attach_client(self.sel, client, conn, addr, reconnect, pending.received)
+
+    def _find_client(self, session_id, addr):
+        """Return (client, reconnect) for copter connected from addr, new client is created for unknown copter."""
+        if session_id is not None:
+            client = Client.clients.get(session_id, None)
+            if client is not None and client.connected and client.addr[0] != addr[0]:
+                # identically imaged copters share ids derived from hostname, connected copter is kept
+                logging.warning("Copter id {} is used by {} and {}, identifying {} by IP address".format(
+                    session_id, client.addr, addr, addr[0]))
+                session_id = None
+                client = Client.clients.get(addr[0], None)
+        else:  # copters without session id are told apart by IP address only
+            client = Client.clients_by_ip.get(addr[0], None)
+
+        if client is None:
+            client = self.client_class(session_id if session_id is not None else addr[0])
             client.buffer_size = self.config.server_buffer_size
+            client.socket_sndbuf = self.config.server_socket_sndbuf
+            client.socket_rcvbuf = self.config.server_socket_rcvbuf
+            client.binary_header = self.config.server_binary_header
+            client.compression_threshold = self.config.server_compression_threshold
+            client.compression_level = self.config.server_compression_level
+            client.request_timeout = self.config.server_request_timeout
+            client.ping_interval = self.config.server_ping_interval
+            client.clock_filter = ExchangeFilter(self.config.server_ping_window)
+            client.time_source = self.time_now
+            client.send_queue_messages = self.config.server_send_queue_messages
+            client.send_queue_bytes = self.config.server_send_queue_bytes
+            client.queue_policies[messaging.PRIORITY_NORMAL] = self.config.server_send_queue_normal_policy
+            reconnect = False
             logging.info("New client")
         else:
-            client = Client.clients[addr[0]]
-            client.close(True)  # to ensure in unregistering
+            if client.connected:
+                logging.warning("Client {} reconnected from {} while connected from {}".format(
+                    client.copter_id, addr, client.addr))
+            reconnect = True
             logging.info("Reconnected client")
-        self.sel.register(conn, selectors.EVENT_READ, data=client)
-        client.connect(self.sel, conn, addr)
+        return client, reconnect
 
     def _ip_broadcast(self):
         logging.info("Broadcast sender thread started!")
@@ -255,7 +589,191 @@ class Server(messaging.Singleton):
             logging.info("Broadcast listener thread stopped, socked closed!")
 
     def send_starttime(self, copter, start_time):
-        copter.send_message("start", kwargs={"time": str(start_time)})
+        copter.send_message("start", kwargs={"time": str(copter.to_copter_time(start_time))})
+
+    def send_resume(self, clients, resume_time):
+        """Resume paused clients at resume_time of server clock, converted to clock of each copter."""
+        return self.send_command(clients, "resume", kwargs={"time": resume_time},
+                                 client_kwargs={client: {"time": client.to_copter_time(resume_time)}
+                                                for client in clients})
+
+    def _create_command_socket(self):
+        command_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        first_octet = int(self.config.broadcast_command_ip.split(".")[0])
+        if 224 <= first_octet <= 239:  # multicast group
+            command_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        else:
+            command_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        return command_sock
+
+    def send_command(self, clients, action, args=(), kwargs=None, client_kwargs=None):
+        """Send command to clients at once over UDP command channel.
+
+        Command is sent redundantly with sequence number and acknowledged by copters over TCP;
+        copters which did not acknowledge it in time receive it over TCP.
+        Copters not announcing udp_commands capability receive the command over TCP at once.
+        client_kwargs maps client to kwargs overriding ones of the command for this client only.
+        """
+        if kwargs is None:
+            kwargs = {}
+        if client_kwargs is None:
+            client_kwargs = {}
+        clients = [client for client in clients if client.connected]
+        udp_clients = [client for client in clients
+                       if client.copter_id is not None and client.peer_capabilities.get("udp_commands", False)]
+        if self.command_socket is None or not udp_clients:
+            for client in clients:
+                client.send_message(action, args, dict(kwargs, **client_kwargs.get(client, {})))
+            return None
+
+        seq = next(self._command_seq)
+        command = {"seq": seq, "server_id": self.id, "targets": [client.copter_id for client in udp_clients],
+                   "action": action, "args": args, "kwargs": kwargs}
+        if client_kwargs:
+            command["target_kwargs"] = {client.copter_id: client_kwargs[client] for client in udp_clients
+                                        if client in client_kwargs}
+        datagram = messaging.MessageManager.create_action_message(
+            "command", kwargs=command, compression=messaging.Compression(1024, 6))
+        with self._commands_lock:
+            self._pending_commands[seq] = PendingCommand(command=command, clients=udp_clients, acks={},
+                                                         sent=time.time())
+        # not identified clients can not be targeted, others do not listen for commands over UDP
+        udp_targets = set(udp_clients)
+        for client in clients:
+            if client not in udp_targets:
+                client.send_message(action, args, dict(kwargs, **client_kwargs.get(client, {})))
+
+        self._send_command_datagram(datagram)
+        for repeat in range(1, self.config.broadcast_command_redundancy):
+            threading.Timer(repeat * self.config.broadcast_command_interval,
+                            self._send_command_datagram, (datagram, )).start()
+        threading.Timer(self.config.broadcast_command_ack_timeout, self._command_ack_timeout, (seq, )).start()
+        logging.info("Command {} #{} sent over UDP to {} copters".format(action, seq, len(udp_clients)))
+        return seq
+
+    def _send_command_datagram(self, datagram):
+        try:
+            self.command_socket.sendto(datagram, (self.config.broadcast_command_ip,
+                                                  self.config.broadcast_command_port))
+        except (OSError, AttributeError) as e:  # socket is closed on server stop
+            logging.error(f"Cannot send command datagram due error {e}")
+
+    def process_command_ack(self, client, seq, received, via):
+        with self._commands_lock:
+            pending = self._pending_commands.get(seq, None)
+            if pending is None:
+                logging.debug(f"Late acknowledgement of command #{seq} from {client.copter_id}")
+                return
+            # copters report receive time by their own clocks, spread is measured by server clock
+            pending.acks[client] = (client.to_server_time(received), via)
+            complete = len(pending.acks) == len(pending.clients)
+            if complete:
+                self._pending_commands.pop(seq)
+        if complete:
+            self._report_command(pending)
+
+    def _command_ack_timeout(self, seq, fallback=True):
+        with self._commands_lock:
+            pending = self._pending_commands.get(seq, None)
+            if pending is None:
+                return
+            missing = [client for client in pending.clients if client not in pending.acks]
+            if not fallback:
+                self._pending_commands.pop(seq)
+
+        if fallback:
+            command = pending.command
+            logging.warning("Command {} #{} was not acknowledged by {}, sending over TCP".format(
+                command["action"], seq, ", ".join(str(client.copter_id) for client in missing)))
+            for client in missing:
+                client.send_message("command", kwargs=command)
+            threading.Timer(self.config.broadcast_command_ack_timeout, self._command_ack_timeout,
+                            (seq, False)).start()
+        else:
+            self._report_command(pending, missing)
+
+    @staticmethod
+    def _report_command(pending, missing=()):
+        received = [received for received, via in pending.acks.values()]
+        udp_count = sum(1 for received, via in pending.acks.values() if via == "udp")
+        spread = (max(received) - min(received)) if received else 0.0
+        pending.spread = spread
+        logging.info("Command {} #{}: {}/{} copters acknowledged ({} over UDP), "
+                     "receive time spread {:.1f} ms{}".format(
+                         pending.command["action"], pending.command["seq"], len(pending.acks), len(pending.clients),
+                         udp_count, spread * 1000,
+                         ", not acknowledged by " + ", ".join(str(client.copter_id) for client in missing)
+                         if missing else ""))
+
+
+    def start_fleet(self, clients, start_time, timeout, on_update=None):
+        """Send start time to clients with single command and track copters armed for start.
+
+        Every copter receives start time converted to its clock and acknowledges the number of scheduled tasks
+        and time of its first frame. on_update(fleet_start, client) is called on each acknowledgement
+        and with client None when all copters answered or timeout in seconds passed.
+        """
+        clients = [client for client in clients if client.connected]
+        start_id = next(self._start_seq)
+        fleet_start = FleetStart(start_id=start_id, clients=clients, start_time=start_time,
+                                 deadline=time.time() + timeout, armed={}, failed={}, finished=False,
+                                 on_update=on_update)
+        with self._commands_lock:
+            self._fleet_starts[start_id] = fleet_start
+
+        self.send_command(clients, "start", kwargs={"time": str(start_time), "start_id": start_id},
+                          client_kwargs={client: {"time": str(client.to_copter_time(start_time))}
+                                         for client in clients if client.clock_estimate is not None})
+        threading.Timer(timeout, self._finish_start, (start_id, )).start()
+        logging.info("Start #{} sent to {} copters".format(start_id, len(clients)))
+        return fleet_start
+
+    def process_start_ack(self, client, start_id, tasks, first_frame, error=None):
+        with self._commands_lock:
+            fleet_start = self._fleet_starts.get(start_id, None)
+            if fleet_start is None or client not in fleet_start.clients:
+                logging.debug(f"Late start #{start_id} acknowledgement from {client.copter_id}")
+                return
+            if error is None:
+                fleet_start.armed[client] = (tasks, first_frame)
+            else:
+                fleet_start.failed[client] = error
+                logging.warning(f"Copter {client.copter_id} failed start #{start_id}: {error}")
+            complete = fleet_start.complete
+
+        if fleet_start.on_update:
+            fleet_start.on_update(fleet_start, client)
+        if complete:
+            self._finish_start(start_id)
+
+    def _finish_start(self, start_id):
+        with self._commands_lock:
+            fleet_start = self._fleet_starts.pop(start_id, None)
+            if fleet_start is None:
+                return
+            fleet_start.finished = True
+
+        waiting = fleet_start.waiting
+        # first frames by server clock show how well start time was compensated for copter clocks
+        first_frames = [client.to_server_time(first_frame) for client, (tasks, first_frame) in fleet_start.armed.items()]
+        spread = (max(first_frames) - min(first_frames)) if first_frames else 0.0
+        logging.info("Start #{}: {}/{} copters armed, first frame spread {:.1f} ms{}".format(
+            start_id, len(fleet_start.armed), len(fleet_start.clients), spread * 1000,
+            ", not armed: " + ", ".join(str(client.copter_id) for client in
+                                        list(fleet_start.failed) + waiting) if waiting or fleet_start.failed else ""))
+        if fleet_start.on_update:
+            fleet_start.on_update(fleet_start, None)
+
+
+@messaging.message_callback("command_ack")
+def _command_ack(client, *args, **kwargs):
+    Server().process_command_ack(client, kwargs["seq"], kwargs["received"], kwargs["via"])
+
+
+@messaging.message_callback("start_ack")
+def _start_ack(client, *args, **kwargs):
+    Server().process_start_ack(client, kwargs["start_id"], kwargs.get("tasks", 0), kwargs.get("first_frame", None),
+                               kwargs.get("error", None))
 
 
 def requires_connect(f):
@@ -277,34 +795,57 @@ def requires_any_connected(f):
 
 
 class Client(messaging.ConnectionManager):
-    clients = {}
+    clients = {}  # session key (copter id or IP address until copter without session id is identified): client
+    clients_by_ip = {}  # IP address: client last connected from it
 
     on_connect = None  # Use as callback functions
     on_first_connect = None
     on_disconnect = None
+    on_transfer_progress = None
 
-    def __init__(self, ip):
+    def __init__(self, key):
         super().__init__()
+        self.key = key
+        self.client_loop = None  # ClientLoop serving connection if server runs several selector threads
         self.copter_id = None
         self.clover_dir = None
         self.connected = False
 
-        self.clients[ip] = self
+        self.telemetry_seq = None
+        self._telemetry_resync_requested = False
+
+        self.ping_interval = 2.0  # seconds, 0 to disable pings
+        self.clock_filter = ExchangeFilter()
+        self.time_source = time.time
+        self._next_ping = 0.0
+
+        self.clients[key] = self
 
     @staticmethod
     def get_by_id(copter_id):
-        for client in Client.clients.values():  # TODO filter
-            if client.copter_id == copter_id:
-                return client
+        return Client.clients.get(copter_id, None)
+
+    def _set_key(self, key):
+        other = self.clients.get(key, None)
+        if other is not None and other is not self:
+            logging.warning("Copter id {} is used by {} and {}".format(key, other.addr, self.addr))
+            if other.connected:  # connected copter keeps the id, this one stays identified by IP address
+                return
+        if self.clients.get(self.key, None) is self:
+            self.clients.pop(self.key)
+        self.key = key
+        self.clients[key] = self
 
     def connect(self, client_selector, client_socket, client_addr):
         logging.info("Client connected")
         if not self.resume_queue:
-            self._send_queue = collections.deque()
+            self._clear_send_queues()
 
+        self.connected = True  # before connecting to allow sending of capabilities and resent requests
+        self.telemetry_seq = None
+        self._telemetry_resync_requested = False
         super().connect(client_selector, client_socket, client_addr)
-
-        self.connected = True
+        self.clients_by_ip[client_addr[0]] = self
 
         #if self.copter_id is None:
         self.get_response("id", self._got_id)
@@ -312,10 +853,18 @@ class Client(messaging.ConnectionManager):
         if self.on_connect:
             self.on_connect(self)
 
+    def process_handshake_data(self, data):
+        """Process data received from copter before its connection was attached to this client."""
+        self.io_stats.recv_bytes += len(data)
+        self._recv_buffer.extend(data)
+        self._process_recv_buffer()
+
     def _got_id(self, _client, value):
         logging.info("Got copter id: {} for client {}".format(value, self.addr))
         old_id = self.copter_id
         self.copter_id = value
+        if self.key != value:
+            self._set_key(value)
 
         if old_id is None:
             self.get_response("clover_dir", self._got_clover_dir)
@@ -326,6 +875,60 @@ class Client(messaging.ConnectionManager):
     def _got_clover_dir(self, _client, value):
         self.clover_dir = value
 
+    def run_timers(self):
+        """Expire requests and ping copter when due, called periodically by loop serving the connection."""
+        self.expire_requests()
+        if not self.ping_interval or not self.connected or self.copter_id is None:
+            return
+        now = time.time()
+        if now >= self._next_ping:
+            self._next_ping = now + self.ping_interval
+            self.ping()
+
+    def ping(self):
+        """Send four timestamp exchange request to estimate copter clock offset and network delay."""
+        self.get_response("ping", self._got_ping, callback_args=(self.time_source(), ),
+                          timeout=max(self.ping_interval, 1.0))
+
+    def _got_ping(self, _client, value, sent):
+        returned = self.time_source()
+        try:
+            received, replied = value
+        except (TypeError, ValueError):
+            logging.warning("Got wrong ping response from {}: {}".format(self.copter_id, value))
+            return
+        self.clock_filter.add(sent, received, replied, returned)
+
+    @property
+    def clock_estimate(self):
+        """[copter clock offset, one-way delay] in seconds or None if copter was not pinged yet."""
+        if self.clock_filter.offset is None:
+            return None
+        return [self.clock_filter.offset, self.clock_filter.delay]
+
+    def to_copter_time(self, server_time):
+        """Convert server time to time of copter clock using estimated offset."""
+        offset = self.clock_filter.offset
+        return server_time + offset if offset is not None else server_time
+
+    def to_server_time(self, copter_time):
+        """Convert time of copter clock to server time using estimated offset."""
+        offset = self.clock_filter.offset
+        return copter_time - offset if offset is not None else copter_time
+
+    def check_telemetry_seq(self, seq, keyframe):
+        """Track sequence of delta encoded telemetry and request full telemetry after a gap."""
+        if seq is None:  # copter sends full telemetry
+            return
+        if keyframe:
+            self._telemetry_resync_requested = False
+        elif (self.telemetry_seq is None or seq != self.telemetry_seq + 1) and not self._telemetry_resync_requested:
+            logging.info("Telemetry of {} is out of sync (got {} after {}), requesting resync".format(
+                self.copter_id, seq, self.telemetry_seq))
+            self._telemetry_resync_requested = True
+            self.send_message("telemetry_resync")
+        self.telemetry_seq = seq
+
     def close(self, inner=False):
         self.connected = False
 
@@ -344,28 +947,70 @@ class Client(messaging.ConnectionManager):
             self.close()
 
         try:
-            self.clients.pop(self.addr[0])
+            self.clients.pop(self.key)
         except KeyError as e:
             logging.error(e)
+        if self.clients_by_ip.get(self.addr[0], None) is self:
+            self.clients_by_ip.pop(self.addr[0])
+        if self.client_loop is not None:
+            self.client_loop.clients.discard(self)
 
         logging.info("Client {} successfully removed!".format(self.copter_id))
 
+    def _transfer_progress(self, filepath, transferred, total):
+        super()._transfer_progress(filepath, transferred, total)
+        if self.on_transfer_progress:
+            self.on_transfer_progress(self, filepath, transferred, total)
+
     @requires_connect
-    def _send(self, data):
-        super()._send(data)
-        logging.debug("Queued data to send (first 256 bytes): {}".format(data[:256]))
+    def _send(self, data, *args, **kwargs):
+        queued = super()._send(data, *args, **kwargs)
+        if isinstance(data, messaging.FileStream):
+            logging.debug("Queued file stream to send: {}".format(data))
+        else:
+            logging.debug("Queued data to send (first 256 bytes): {}".format(data[:256]))
+        return queued
+
+    def request_async(self, requested_value, request_args=(), request_kwargs=None, timeout=None, loop=None):
+        """Awaitable version of request() for the asyncio event loop of the GUI."""
+        return asyncio.wrap_future(self.request(requested_value, request_args, request_kwargs, timeout), loop=loop)
+
+    @staticmethod
+    def gather_responses(clients, requested_value, timeout, request_args=(), request_kwargs=None, loop=None):
+        """Await responses of all clients for at most timeout seconds.
+
+        Result is OrderedDict of client: response value or exception (TimeoutError if client did not answer).
+        """
+        return asyncio.wrap_future(messaging.gather_requests(clients, requested_value, timeout,
+                                                             request_args, request_kwargs), loop=loop)
 
     @staticmethod
     @requires_any_connected
-    def broadcast(message, force_all=False):
+    def broadcast(message, force_all=False, priority=messaging.PRIORITY_CONTROL):
         for client in Client.clients.values():
             if client.connected or force_all:
-                client._send(message)
+                client._send(message, priority)
 
     @classmethod
     @requires_any_connected
     def broadcast_message(cls, command, args=(), kwargs=None, force_all=False):
-        cls.broadcast(messaging.MessageManager.create_action_message(command, args, kwargs), force_all)
+        messages = {}  # message is created once for each message format used by clients
+        for client in Client.clients.values():
+            if client.connected or force_all:
+                options = client.message_options
+                message_format = tuple(sorted(options.items()))
+                if message_format not in messages:
+                    messages[message_format] = messaging.MessageManager.create_action_message(
+                        command, args, kwargs, **options)
+                client._send(messages[message_format], messaging.PRIORITY_CONTROL)
+
+
+class AsyncioClient(Client, AsyncioConnection):
+    """Client served by asyncio event loop of the server."""
+    def connection_lost(self, exc):
+        logging.warning("Connection to {} lost{}".format(self.addr, ": {}".format(exc) if exc else "!"))
+        self.transport = None
+        self.close(True)
 
 
 if __name__ == '__main__':
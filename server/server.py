@@ -38,6 +38,10 @@ from modules.config_editor_models import ConfigDialog
 
 startup_cwd = os.getcwd()
 
+# seconds to wait for long operations on copters, which are not limited in time there
+CALIBRATION_TIMEOUT = 300.0
+LOAD_PARAMS_TIMEOUT = 120.0
+
 def multi_glob(*patterns):
     return itertools.chain.from_iterable(glob.iglob(pattern) for pattern in patterns)
 
@@ -99,10 +103,17 @@ class ServerQt(Server):
         table.ModelChecks.battery_min = self.config.checks_battery_min
         table.ModelChecks.start_pos_delta_max = self.config.checks_start_pos_delta_max
         table.ModelChecks.time_delta_max = self.config.checks_time_delta_max
+        table.ModelChecks.send_queue_max = self.config.checks_send_queue_max
+        table.ModelChecks.clock_uncertainty_max = self.config.checks_clock_uncertainty_max
 
 
 # noinspection PyCallByClass,PyArgumentList
 class MainWindow(QtWidgets.QMainWindow):
+    transfer_progress_signal = QtCore.pyqtSignal(str)
+    # telemetry decoded by selector threads is handed over to GUI thread with one queued signal per message
+    telemetry_signal = QtCore.pyqtSignal(object, dict)
+    start_progress_signal = QtCore.pyqtSignal(object, object)
+
     def __init__(self, server):
         super(MainWindow, self).__init__()
 
@@ -129,9 +140,9 @@ class MainWindow(QtWidgets.QMainWindow):
         self.ui.z_checkbox.clicked.connect(self.ui.z_spin.setEnabled)
         self.ui.z_spin.setEnabled(False)
 
-        self.ui.land_all_button.clicked.connect(b_partial(Client.broadcast_message, "land"))
+        self.ui.land_all_button.clicked.connect(b_partial(self.send_to_all, "land"))
         self.ui.land_selected_button.clicked.connect(b_partial(self.send_to_selected, "land"))
-        self.ui.disarm_all_button.clicked.connect(b_partial(Client.broadcast_message, "disarm"))
+        self.ui.disarm_all_button.clicked.connect(b_partial(self.send_to_all, "disarm"))
         self.ui.disarm_selected_button.clicked.connect(b_partial(self.send_to_selected, "disarm"))
         self.ui.visual_land_button.clicked.connect(self.visual_land)
         self.ui.emergency_land_button.clicked.connect(b_partial(self.send_to_selected, "emergency_land"))
@@ -183,6 +194,10 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.ui.action_update_client_repo.triggered.connect(b_partial(self.send_to_selected, "update_repo"))
 
+        self.transfer_progress_signal.connect(self.statusBar().showMessage)
+        self.telemetry_signal.connect(self.update_table_data)
+        self.start_progress_signal.connect(self.update_start_progress)
+
     def init_table(self):
         # Remove standard table widget
         self.ui.horizontalLayout.removeWidget(self.ui.tableView)
@@ -251,11 +266,15 @@ class MainWindow(QtWidgets.QMainWindow):
 
     @pyqtSlot()
     def send_to_selected(self, command, command_args=(), command_kwargs=None):
-        return list(self.iterate_selected(lambda copter: copter.client.send_message(
-            command, command_args, command_kwargs)))
+        clients = [copter.client for copter in self.model.user_selected()]
+        return server.send_command(clients, command, command_args, command_kwargs)
+
+    @pyqtSlot()
+    def send_to_all(self, command, command_args=(), command_kwargs=None):
+        return server.send_command(list(Client.clients.values()), command, command_args, command_kwargs)
 
     def new_client_connected(self, client: Client):
-        if self.model.get_row_by_attr('client', client) is not None:
+        if self.model.get_row_by_client(client) is not None:
             logging.warning("Client is already in table! {}".format(client))
             return
 
@@ -264,7 +283,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def client_connection_changed(self, client: Client):
         logging.debug("Connection {} changed {}".format(client, client.connected))
-        row_data = self.model.get_row_by_attr("client", client)
+        row_data = self.model.get_row_by_client(client)
 
         if row_data is None:
             logging.error("No row for client presented")
@@ -275,28 +294,35 @@ class MainWindow(QtWidgets.QMainWindow):
             self.model.remove_client_data(row_data)
             logging.debug("Removing from table")
         else:
-            row_num = self.model.get_row_index(row_data)
+            row_num = self.model.get_client_row(client)
             if row_num is not None:
                 self.model.update_data(row_num, 0, client.connected, table.ModelStateRole)
                 logging.debug("Client status updated")
 
+    def transfer_progress(self, client: Client, filepath, transferred, total):
+        percent = transferred / total if total else 1
+        self.transfer_progress_signal.emit(f"File {os.path.basename(filepath)} ({client.copter_id}): "
+                                           f"{transferred}/{total} bytes, {percent:.0%}")
+
     @pyqtSlot()
     def selfcheck_selected(self):
-        for copter in self.model.user_selected():
-            copter.client.get_response("telemetry", self.update_table_data)
+        clients = [copter.client for copter in self.model.user_selected()]
+        asyncio.ensure_future(self.selfcheck(clients), loop=loop)
+
+    async def selfcheck(self, clients, timeout=5.0):
+        results = await Client.gather_responses(clients, "telemetry", timeout)
+        answered = 0
+        for client, value in results.items():
+            if isinstance(value, Exception):
+                logging.warning(f"Copter {client.copter_id} did not pass selfcheck: {value}")
+            else:
+                answered += 1
+                self.update_table_data(client, dict(value, send_queue=client.send_queue_depth))
+        logging.info(f"Selfcheck: {answered}/{len(clients)} copters answered")
 
     @pyqtSlot(object, dict)
     def update_table_data(self, client, telems: dict):
-        for key, value in telems.items():
-            try:
-                col = self.model.columns.index(key)
-            except ValueError:
-                logging.debug(f"No column {key} present!")
-            else:
-                row_data = self.model.get_row_by_attr("client", client)
-                row_num = self.model.get_row_index(row_data)
-                if row_num is not None:
-                    self.model.update_data(row_num, col, value, Qt.EditRole)
+        self.model.update_row(client, telems)
 
     @pyqtSlot()
     def remove_selected(self):
@@ -319,8 +345,35 @@ class MainWindow(QtWidgets.QMainWindow):
             logging.info('Wait {} seconds to play music'.format(music_dt))
         # This filter constraints takeoff in real world, when copter state was normal and then some checks were failed for a while
         # for copter in filter(lambda copter: copter.states.all_checks, self.model.user_selected()):
-        for copter in self.model.user_selected():
-            server.send_starttime(copter.client, dt + time_now + time_lag)
+        clients = [copter.client for copter in self.model.user_selected()]
+        fleet_start = server.start_fleet(clients, dt + time_now + time_lag, self.server.config.server_start_timeout,
+                                         self.start_progress_signal.emit)
+        self.update_start_progress(fleet_start, None)
+
+    @pyqtSlot(object, object)
+    def update_start_progress(self, fleet_start, client):
+        col = self.model.columns.index("start_status")
+        armed, failed = dict(fleet_start.armed), dict(fleet_start.failed)  # acknowledgements arrive concurrently
+        clients = fleet_start.clients if client is None else [client]
+        for client in clients:
+            if client in armed:
+                value, state = ["armed", armed[client][0]], True
+            elif client in failed:
+                value, state = ["failed", failed[client]], False
+            elif fleet_start.finished:
+                value, state = ["no answer"], False
+            else:
+                value, state = ["waiting"], None  # highlighted as missing until deadline
+            row_num = self.model.get_client_row(client)
+            if row_num is not None:
+                self.model.update_data(row_num, col, value)
+                self.model.update_data(row_num, col, state, table.ModelStateRole)
+
+        message = f"Armed for start: {len(armed)}/{len(fleet_start.clients)}"
+        not_armed = [client for client in fleet_start.clients if client not in armed]
+        if fleet_start.finished and not_armed:
+            message += ", not armed: " + ", ".join(str(client.copter_id) for client in not_armed)
+        self.statusBar().showMessage(message)
 
     @pyqtSlot()
     def pause_resume_selected(self):
@@ -329,7 +382,8 @@ class MainWindow(QtWidgets.QMainWindow):
             self.ui.pause_button.setText('Resume')
         else:
             time_gap = 0.1  # TODO config? automatic delay detection?
-            self.send_to_selected("resume", command_kwargs={"time": server.time_now() + time_gap})
+            clients = [copter.client for copter in self.model.user_selected()]
+            server.send_resume(clients, server.time_now() + time_gap)
             self.ui.pause_button.setText('Pause')
 
     @pyqtSlot()
@@ -359,7 +413,8 @@ class MainWindow(QtWidgets.QMainWindow):
             data = 'CALIBRATING'
             self.model.update_data(row, col, data, table.ModelDataRole)
             # Send request
-            client.get_response("calibrate_gyro", self._get_calibration_info)
+            client.get_response("calibrate_gyro", self._get_calibration_info,
+                                timeout=CALIBRATION_TIMEOUT, timeout_callback=self._calibration_timeout)
 
     @pyqtSlot()
     def calibrate_level_selected(self):
@@ -371,21 +426,26 @@ class MainWindow(QtWidgets.QMainWindow):
             data = 'CALIBRATING'
             self.model.update_data(row, col, data, table.ModelDataRole)
             # Send request
-            client.get_response("calibrate_level", self._get_calibration_info)
+            client.get_response("calibrate_level", self._get_calibration_info,
+                                timeout=CALIBRATION_TIMEOUT, timeout_callback=self._calibration_timeout)
 
     def _get_calibration_info(self, client, value):
         col = 5
-        row_data = self.model.get_row_by_attr("client", client)
-        row = self.model.get_row_index(row_data)
+        row = self.model.get_client_row(client)
         if row is not None:
             data = str(value)
             self.model.update_data(row, col, data, table.ModelDataRole)
 
+    def _calibration_timeout(self, client):
+        logging.error("Calibration of {} did not finish in {} seconds".format(client.copter_id, CALIBRATION_TIMEOUT))
+        self._get_calibration_info(client, "NO_INFO")
+
     def _send_files(self, files, copters=None, client_path="", client_filename="", match_id=False, callback=None, clover_dir=False):
         if copters is None:
             copters = self.model.user_selected()
         copters = list(copters)
 
+        transfers = []
         for num, file in enumerate(files):
             filepath, filename = os.path.split(file)
             logging.info("Preparing file for sending: {} {}".format(filepath, filename))
@@ -409,11 +469,49 @@ class MainWindow(QtWidgets.QMainWindow):
                         path_to_send = os.path.realpath(os.path.join(copter.client.clover_dir, client_path))
                     else:
                         logging.error("Can't send files to clover ROS package on {}".format(copter.copter_id))
+                        continue
                 else:
                     path_to_send = client_path
-                copter.client.send_file(file, os.path.join(path_to_send, filename))
-                if callback is not None:
-                    callback(copter)
+                transfers.append((copter, file, os.path.join(path_to_send, filename)))
+
+        if transfers:
+            asyncio.ensure_future(self.push_files(transfers, callback), loop=loop)
+
+    async def push_files(self, transfers, callback=None, timeout=5.0):
+        """Send files to copters skipping ones with the same SHA-256 already present at destination.
+
+        Callback is called for each copter after its file is queued, messages it sends with PRIORITY_BULK
+        are handled by copter after the file is received.
+        """
+        local_hashes = {file: messaging.file_hash(file) for file in {file for _, file, _ in transfers}}
+
+        destinations = {}
+        for copter, _, dest_filepath in transfers:
+            destinations.setdefault(copter.client, []).append(dest_filepath)
+        clients = list(destinations.keys())
+        responses = await asyncio.gather(*(client.request_async("file_hash", request_kwargs={"filepaths": paths},
+                                                                timeout=timeout, loop=loop)
+                                           for client, paths in destinations.items()),
+                                         return_exceptions=True)
+        remote_hashes = {}
+        for client, response in zip(clients, responses):
+            if isinstance(response, Exception):
+                logging.warning(f"Can't get file hashes from {client.copter_id}, sending all files: {response}")
+            else:
+                remote_hashes[client] = response
+
+        skipped = sent = 0
+        for copter, file, dest_filepath in transfers:
+            local_hash = local_hashes[file]
+            if local_hash is not None and remote_hashes.get(copter.client, {}).get(dest_filepath) == local_hash:
+                logging.debug(f"File {dest_filepath} on {copter.copter_id} is up to date")
+                skipped += 1
+            else:
+                copter.client.send_file(file, dest_filepath)
+                sent += 1
+            if callback is not None:
+                callback(copter)
+        logging.info(f"Files pushed: {skipped} skipped / {sent} sent")
 
     def send_files(self, prompt, ext_filter, copters=None, client_path="", client_filename="", match_id=False,
                    onefile=False, callback=None, clover_dir=False):
@@ -499,8 +597,8 @@ class MainWindow(QtWidgets.QMainWindow):
 
     @pyqtSlot()
     def send_aruco(self):
-        def callback(copter):
-            copter.client.send_message("service_restart", kwargs={"name": "clover"})
+        def callback(copter):  # restart after map is received
+            copter.client.send_message("service_restart", kwargs={"name": "clover"}, priority=messaging.PRIORITY_BULK)
 
         self.send_files("Select aruco map configuration file", "Aruco map files (*.txt)", onefile=True,
                         client_path="../aruco_pose/map/", client_filename="animation_map.txt",
@@ -516,8 +614,13 @@ class MainWindow(QtWidgets.QMainWindow):
         def request_callback(client, value):
             logging.info("Send parameters to {} success: {}".format(client.copter_id, value))
 
-        def callback(copter):
-            copter.client.get_response("load_params", request_callback)
+        def timeout_callback(client):
+            logging.error("Parameters were not loaded by {} in {} seconds".format(client.copter_id,
+                                                                                   LOAD_PARAMS_TIMEOUT))
+
+        def callback(copter):  # load parameters after file is received
+            copter.client.get_response("load_params", request_callback, timeout=LOAD_PARAMS_TIMEOUT,
+                                       timeout_callback=timeout_callback, priority=messaging.PRIORITY_BULK)
 
         self.send_files("Select px4 param file", "px4 params (*.params)", onefile=True,
                         client_filename="temp.params", callback=callback)
@@ -632,8 +735,11 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def register_callbacks(self):
         @messaging.message_callback("telemetry")
-        def get_telem_data(client, value, **kwargs):
-            self.update_table_data(client, value)
+        def get_telem_data(client, value, seq=None, keyframe=True, **kwargs):
+            client.check_telemetry_seq(seq, keyframe)
+            # delta encoded telemetry contains only changed values
+            self.telemetry_signal.emit(client, dict(value, send_queue=client.send_queue_depth,
+                                                    clock_estimate=client.clock_estimate))
 
 
 def except_hook(cls, exception, traceback):
@@ -694,6 +800,7 @@ if __name__ == "__main__":
         Client.on_first_connect = window.new_client_connected
         Client.on_connect = window.client_connection_changed
         Client.on_disconnect = window.client_connection_changed
+        Client.on_transfer_progress = window.transfer_progress
 
         app.aboutToQuit.connect(window.on_quit)
 
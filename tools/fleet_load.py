@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import collections
+import multiprocessing
+
+# Add parent dir to PATH to import messaging_lib and config_lib
+current_dir = (os.path.dirname(os.path.realpath(__file__)))
+root_dir = os.path.realpath(os.path.join(current_dir, '..'))
+lib_dir = os.path.realpath(os.path.join(root_dir, 'lib'))
+server_dir = os.path.realpath(os.path.join(root_dir, 'server'))
+sys.path.insert(0, lib_dir)
+
+import messaging
+from messaging_benchmark import percentiles
+
+# Telemetry sample as sent by mock_telem() of the client
+TELEMETRY_SAMPLE = dict([('fcu_status', 'STANDBY'), ('current_position', [-1.17, 2.04, 3.45, 0, "11"]),
+                         ('animation_id', 'two_drones_test'), ('selfcheck', 'OK'), ('battery', [12.2, 1.0]),
+                         ('git_version', '42aee96'), ('calibration_status', None), ('start_position', [0.2, 0.2, 0.0]),
+                         ('mode', 'MANUAL'), ('time_delta', 1581342970.889573), ('armed', False),
+                         ('config_version', 'Copter config V0.0'), ('last_task', 'No task')])
+
+
+class FakeCopter(messaging.ConnectionManager):
+    """Copter speaking the real protocol without ROS, flight controller and files."""
+    def __init__(self, copter_id):
+        super(FakeCopter, self).__init__()
+        self.copter_id = copter_id
+        self.session_id = copter_id
+
+
+@messaging.request_callback("id")
+def _response_id(connection, *args, **kwargs):
+    return connection.copter_id
+
+
+@messaging.request_callback("clover_dir")
+def _response_clover_dir(connection, *args, **kwargs):
+    return "/home/pi/catkin_ws/src/clover/clover"
+
+
+@messaging.request_callback("telemetry")
+def _response_telemetry(connection, *args, **kwargs):
+    return TELEMETRY_SAMPLE
+
+
+@messaging.request_callback("config")
+def _response_config(connection, *args, **kwargs):
+    return {"config": {"config_name": "client", "config_version": 1.0, "PRIVATE": {"id": connection.copter_id}}}
+
+
+@messaging.request_callback("time")
+def _response_time(connection, *args, **kwargs):
+    return time.time()
+
+
+@messaging.request_callback("ping")
+def _response_ping(connection, *args, **kwargs):
+    received = time.time()
+    return [received, time.time()]
+
+
+def source_address(index):
+    """Distinct loopback address for each fake copter, as real copters connect from different hosts."""
+    return "127.{}.{}.{}".format(1 + index // 62500, index // 250 % 250, 2 + index % 250)
+
+
+def run_fleet(host, port, indexes, rate, stop_event):
+    """Connect fake copters and stream telemetry at rate messages per second each until stop_event is set."""
+    selector = messaging.selectors.DefaultSelector()
+    waker = messaging.SelectorWaker(selector)
+    copters = []
+    for index in indexes:
+        copter = FakeCopter("fake{:03d}".format(index))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if host.startswith("127."):
+            sock.bind((source_address(index), 0))
+        sock.connect((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        selector.register(sock, messaging.selectors.EVENT_READ, data=copter)
+        copter.connect(selector, sock, (host, port))
+        copters.append(copter)
+
+    # copters send telemetry evenly spread over the period, as their clocks are not aligned
+    period = 1.0 / rate
+    next_sends = [time.time() + period * i / len(copters) for i in range(len(copters))]
+    while not stop_event.is_set():
+        now = time.time()
+        for i, copter in enumerate(copters):
+            if next_sends[i] <= now:
+                copter.send_message("telemetry", kwargs={"value": TELEMETRY_SAMPLE, "sent": time.time()},
+                                    priority=messaging.PRIORITY_NORMAL, droppable=True)
+                next_sends[i] += period
+        timeout = max(0.0, min(next_sends) - time.time())
+        for key, mask in selector.select(timeout=min(timeout, 0.1)):
+            key.data.process_events(mask)
+
+    for copter in copters:
+        copter.socket.close()
+    waker.close()
+    selector.close()
+
+
+class LoadReport(object):
+    """Lag samples collected by the server, GUI thread and request callbacks."""
+    def __init__(self):
+        self.receive_lag = []
+        self.gui_lag = []
+        self.rtt = []
+        self.requests_sent = 0
+        self.requests_failed = 0
+        self.recording = False
+        self.lock = threading.Lock()
+
+    def add(self, samples, value):
+        if self.recording:
+            with self.lock:
+                samples.append(value)
+
+    def result(self, clients, transport, selector_threads, duration):
+        result = collections.OrderedDict([
+            ("clients", clients),
+            ("transport", transport),
+            ("selector_threads", selector_threads),
+            ("duration_s", round(duration, 2)),
+            ("telemetry_received", len(self.receive_lag)),
+            ("telemetry_per_s", round(len(self.receive_lag) / duration, 1)),
+            ("requests_sent", self.requests_sent),
+            ("requests_failed", self.requests_failed),
+        ])
+        for name, samples in (("receive_lag_ms", self.receive_lag), ("gui_lag_ms", self.gui_lag),
+                              ("rtt_ms", self.rtt)):
+            result[name] = percentiles(samples) if samples else None
+        return result
+
+
+def create_config(directory, port, transport, selector_threads):
+    spec_dir = os.path.join(directory, "spec")
+    os.mkdir(spec_dir)
+    shutil.copy(os.path.join(server_dir, "config", "spec", "configspec_server.ini"), spec_dir)
+    config_path = os.path.join(directory, "server.ini")
+    with open(config_path, 'w') as f:
+        f.write("[SERVER]\nport = {}\ntransport = {}\nselector_threads = {}\n"
+                "[BROADCAST]\nsend = False\nlisten = False\ncommands = False\n".format(port, transport,
+                                                                                 selector_threads))
+    return config_path
+
+
+def free_port(host):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+async def measure(server_core, report, args):
+    pending = []
+
+    def on_response(future, request_started):
+        with report.lock:
+            if future.exception() is not None:
+                report.requests_failed += 1
+            else:
+                report.rtt.append(time.time() - request_started)
+
+    clients_count = args.clients
+    deadline = time.time() + args.connect_timeout
+    while time.time() < deadline:
+        identified = [client for client in server_core.Client.clients.values() if client.copter_id is not None]
+        if len(identified) >= clients_count:
+            break
+        await asyncio.sleep(0.1)
+    else:
+        logging.error("Only {}/{} fake copters connected".format(len(identified), clients_count))
+
+    await asyncio.sleep(args.warmup)
+    report.recording = True
+    started = time.time()
+    while time.time() - started < args.duration:
+        for client in list(server_core.Client.clients.values()):
+            request_started = time.time()
+            future = client.request("time", timeout=args.request_timeout)
+            report.requests_sent += 1
+            future.add_done_callback(lambda f, request_started=request_started: on_response(f, request_started))
+            pending.append(future)
+        await asyncio.sleep(args.request_interval)
+    report.recording = False
+    duration = time.time() - started
+
+    # wait for responses to the last requests
+    await asyncio.wait([asyncio.wrap_future(future) for future in pending], timeout=args.request_timeout)
+    return duration
+
+
+def main(args):
+    sys.path.insert(0, server_dir)
+    from modules import server_core
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    report = LoadReport()
+
+    def gui_update(client, value, received):
+        # stands for table model update made by GUI event loop
+        report.add(report.gui_lag, time.time() - received)
+        if args.gui_cost:
+            busy_until = time.time() + args.gui_cost / 1000.0
+            while time.time() < busy_until:
+                pass
+
+    @messaging.message_callback("telemetry")
+    def _telemetry(client, value, sent=None, **kwargs):
+        received = time.time()
+        if sent is not None:
+            report.add(report.receive_lag, received - sent)
+        loop.call_soon_threadsafe(gui_update, client, value, received)
+
+    directory = tempfile.mkdtemp()
+    port = args.port or free_port(args.host)
+    server = server_core.Server(config_path=create_config(directory, port, args.transport, args.selector_threads))
+    server.ip = args.host
+    server.start()
+
+    stop_event = multiprocessing.Event()
+    indexes = list(range(args.clients))
+    workers = [multiprocessing.Process(target=run_fleet, args=(args.host, port, indexes[i::args.processes],
+                                                               args.rate, stop_event))
+               for i in range(min(args.processes, args.clients))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    try:
+        duration = loop.run_until_complete(measure(server_core, report, args))
+    finally:
+        server.stop()
+        stop_event.set()
+        for worker in workers:
+            worker.join(5)
+        loop.close()
+        shutil.rmtree(directory)
+
+    return report.result(args.clients, args.transport, args.selector_threads, duration)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load server with fleet of fake copters on localhost")
+    parser.add_argument('--clients', type=int, default=300, help="number of fake copters")
+    parser.add_argument('--rate', type=float, default=2.0, help="telemetry messages per second of each copter")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds of measurement")
+    parser.add_argument('--warmup', type=float, default=2.0, help="seconds to wait after all copters connected")
+    parser.add_argument('--processes', type=int, default=4, help="processes running fake copters")
+    parser.add_argument('--host', default="127.0.0.1", help="address of the server")
+    parser.add_argument('--port', type=int, default=0, help="port of the server, free port by default")
+    parser.add_argument('--transport', choices=('threads', 'asyncio'), default='threads',
+                        help="transport of the server")
+    parser.add_argument('--selector-threads', type=int, default=1, help="selector threads of the server")
+    parser.add_argument('--request-interval', type=float, default=1.0,
+                        help="seconds between time requests to every copter for round trip measurement")
+    parser.add_argument('--request-timeout', type=float, default=5.0, help="seconds to wait for request response")
+    parser.add_argument('--connect-timeout', type=float, default=30.0, help="seconds to wait for copters to connect")
+    parser.add_argument('--gui-cost', type=float, default=0.0, help="milliseconds spent by GUI on each update")
+    parser.add_argument('--output', help="also write JSON results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    output = json.dumps(main(args), indent=4)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
@@ -0,0 +1,439 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import collections
+
+from contextlib import closing
+
+# Add parent dir to PATH to import messaging_lib and config_lib
+current_dir = (os.path.dirname(os.path.realpath(__file__)))
+root_dir = os.path.realpath(os.path.join(current_dir, '..'))
+lib_dir = os.path.realpath(os.path.join(root_dir, 'lib'))
+sys.path.insert(0, lib_dir)
+
+import messaging
+
+
+class LegacyMessageManager(messaging.MessageManager):
+    """Parsing logic of bytes-based receive path (before ReceiveBuffer) kept for comparison."""
+    def _process_protoheader(self):
+        header_len = 2
+        if len(self.income_raw) >= header_len:
+            self._jsonheader_len = struct.unpack(">H", self.income_raw[:header_len])[0]
+            self.income_raw = self.income_raw[header_len:]
+
+    def _process_jsonheader(self):
+        header_len = self._jsonheader_len
+        if len(self.income_raw) >= header_len:
+            self.jsonheader = self._json_decode(self.income_raw[:header_len], "utf-8")
+            self.income_raw = self.income_raw[header_len:]
+
+    def _process_content(self):
+        content_len = self.jsonheader["content-length"]
+        if not len(self.income_raw) >= content_len:
+            return
+        data = self.income_raw[:content_len]
+        self.income_raw = self.income_raw[content_len:]
+        if self.jsonheader["content-type"] == "json":
+            self.content = self._json_decode(data, self.jsonheader["content-encoding"])
+        else:
+            self.content = data
+
+    def process_message(self, buffer=None):
+        if self._jsonheader_len is None:
+            self._process_protoheader()
+
+        if self._jsonheader_len is not None:
+            if self.jsonheader is None:
+                self._process_jsonheader()
+
+        if self.jsonheader:
+            if self.content is None:
+                self._process_content()
+
+
+class StreamSocket(object):
+    """Socket stand-in returning prepared data in pieces of requested size."""
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._position = 0
+
+    def recv(self, size):
+        chunk = self._data[self._position:self._position + size].tobytes()
+        self._position += len(chunk)
+        return chunk
+
+    def recv_into(self, view):
+        chunk = self._data[self._position:self._position + len(view)]
+        view[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    @property
+    def exhausted(self):
+        return self._position >= len(self._data)
+
+
+class FragmentedStreamSocket(StreamSocket):
+    """Socket stand-in returning prepared data in pieces of random size, as slow links do."""
+    def __init__(self, data, max_fragment, seed=0):
+        super(FragmentedStreamSocket, self).__init__(data)
+        self._random = random.Random(seed)
+        self._max_fragment = max_fragment
+
+    def recv_into(self, view):
+        size = self._random.randint(1, self._max_fragment)
+        return super(FragmentedStreamSocket, self).recv_into(view[:size])
+
+
+class BenchmarkConnection(messaging.ConnectionManager):
+    def __init__(self, sock, buffer_size):
+        super(BenchmarkConnection, self).__init__()
+        self.socket = sock
+        self.buffer_size = buffer_size
+        self.received = 0
+
+    def process_received(self, message):
+        self.received += 1
+
+
+class LegacyBenchmarkConnection(BenchmarkConnection):
+    def __init__(self, sock, buffer_size):
+        super(LegacyBenchmarkConnection, self).__init__(sock, buffer_size)
+        self._recv_buffer = b""
+
+    def _read(self):
+        data = self.socket.recv(self.buffer_size)
+        self._recv_buffer += data
+        messaging.logger.debug("Received {} bytes from {}".format(len(data), self.addr))
+
+    def read(self):
+        self._read()
+        while self._recv_buffer:
+            if not self._received_queue or (self._received_queue[0].content is not None):
+                self._received_queue.appendleft(LegacyMessageManager())
+
+            last_message = self._received_queue[0]
+
+            last_message.income_raw += self._recv_buffer
+            self._recv_buffer = b''
+            last_message.process_message()
+
+            if last_message.content is not None and last_message.income_raw:
+                self._recv_buffer = last_message.income_raw + self._recv_buffer
+                last_message.income_raw = b''
+
+            if self._received_queue and last_message.content is not None:
+                self.process_received(self._received_queue.popleft())
+
+
+def run_parsing(connection_class, data, messages, buffer_size, sock=None):
+    if sock is None:
+        sock = StreamSocket(data)
+    connection = connection_class(sock, buffer_size)
+    started = time.time()
+    while not sock.exhausted:
+        connection.read()
+    elapsed = time.time() - started
+    assert connection.received == messages, "Lost messages during parsing"
+    return elapsed
+
+
+def bench_parsing(payload_sizes, buffer_size, total_size):
+    results = collections.OrderedDict()
+    for payload_size in payload_sizes:
+        message = messaging.MessageManager.create_message(b"x" * payload_size, "binary", "message",
+                                                          additional_headers={"action": "benchmark"})
+        messages = max(1, total_size // len(message))
+        data = message * messages
+
+        legacy = run_parsing(LegacyBenchmarkConnection, data, messages, buffer_size)
+        current = run_parsing(BenchmarkConnection, data, messages, buffer_size)
+        results[payload_size] = collections.OrderedDict([
+            ("messages", messages),
+            ("legacy_s", round(legacy, 4)),
+            ("current_s", round(current, 4)),
+            ("legacy_mb_s", round(len(data) / legacy / 2 ** 20, 2)),
+            ("current_mb_s", round(len(data) / current / 2 ** 20, 2)),
+            ("speedup", round(legacy / current, 2)),
+        ])
+    return results
+
+
+def bench_fragmented(payload_sizes, buffer_size, total_size):
+    results = collections.OrderedDict()
+    for payload_size in payload_sizes:
+        message = messaging.MessageManager.create_message(b"x" * payload_size, "binary", "message",
+                                                          additional_headers={"action": "benchmark"})
+        messages = max(1, total_size // len(message))
+        data = message * messages
+
+        contiguous = run_parsing(BenchmarkConnection, data, messages, buffer_size)
+        fragmented = run_parsing(BenchmarkConnection, data, messages, buffer_size,
+                                 FragmentedStreamSocket(data, buffer_size))
+        results[payload_size] = collections.OrderedDict([
+            ("messages", messages),
+            ("contiguous_mb_s", round(len(data) / contiguous / 2 ** 20, 2)),
+            ("fragmented_mb_s", round(len(data) / fragmented / 2 ** 20, 2)),
+        ])
+    return results
+
+
+# Telemetry sample as sent by the drone every tick
+TELEMETRY_SAMPLE = {
+    'fcu_status': 'STANDBY', 'current_position': [-1.17, 2.04, 3.45, 0, "aruco_map"],
+    'animation_info': ['two_drones_test', 'OK'], 'selfcheck': 'OK', 'battery': [12.2, 1.0],
+    'git_version': '42aee96', 'calibration_status': 'OK', 'start_position': [0.2, 0.2, 0.0, 0, 'fly', 0.0],
+    'mode': 'MANUAL', 'time_delta': 1581342970.889573, 'armed': False, 'config_version': 'client V1.0',
+    'last_task': 'No task',
+}
+
+
+def bench_headers(iterations):
+    results = collections.OrderedDict()
+    for mode, binary_header in (("json", False), ("binary", True)):
+        create = lambda: messaging.MessageManager.create_response("telemetry", "1234", TELEMETRY_SAMPLE,
+                                                                  binary_header=binary_header)
+        data = create()
+
+        started = time.time()
+        for _ in range(iterations):
+            create()
+        create_time = time.time() - started
+
+        started = time.time()
+        for _ in range(iterations):
+            message = messaging.MessageManager()
+            message.process_message(messaging.ReceiveBuffer.from_bytes(data))
+        process_time = time.time() - started
+
+        content_length = len(messaging.MessageManager._json_encode({"value": TELEMETRY_SAMPLE}))
+        results[mode] = collections.OrderedDict([
+            ("header_bytes", len(data) - content_length),
+            ("message_bytes", len(data)),
+            ("create_us", round(create_time / iterations * 1e6, 2)),
+            ("process_us", round(process_time / iterations * 1e6, 2)),
+        ])
+    return results
+
+
+class SelectorLoop(threading.Thread):
+    """Thread processing events of connections registered in its selector, as server and client do."""
+    def __init__(self):
+        super(SelectorLoop, self).__init__()
+        self.daemon = True
+        self.selector = messaging.selectors.DefaultSelector()
+        self.waker = messaging.SelectorWaker(self.selector)
+        self._running = True
+
+    def run(self):
+        while self._running:
+            for key, mask in self.selector.select(timeout=0.1):
+                key.data.process_events(mask)
+
+    def register(self, connection, sock):
+        sock.setblocking(False)
+        self.selector.register(sock, messaging.selectors.EVENT_READ, data=connection)
+        connection.connect(self.selector, sock, sock.getsockname())
+        self.waker.notify()
+
+    def stop(self):
+        self._running = False
+        self.waker.notify()
+        self.join()
+        self.waker.close()
+        self.selector.close()
+
+
+class CountingConnection(messaging.ConnectionManager):
+    """Connection counting received broadcast messages."""
+    def __init__(self, event_counter):
+        super(CountingConnection, self).__init__()
+        self.event_counter = event_counter
+
+    def process_received(self, message):
+        if message.jsonheader.get("action") == "benchmark":
+            self.event_counter.increment()
+        else:
+            super(CountingConnection, self).process_received(message)
+
+
+class EventCounter(object):
+    def __init__(self, target):
+        self.target = target
+        self.count = 0
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def increment(self):
+        with self._lock:
+            self.count += 1
+            if self.count >= self.target:
+                self.done.set()
+
+
+class Loopback(object):
+    """Connection pairs over localhost TCP, server ends and client ends are processed by separate threads."""
+    def __init__(self, connections, client_factory=messaging.ConnectionManager):
+        self.server_loop, self.client_loop = SelectorLoop(), SelectorLoop()
+        self.servers, self.clients = [], []
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(connections)
+        with closing(listener):
+            for _ in range(connections):
+                client_sock = socket.create_connection(listener.getsockname())
+                server_sock, _ = listener.accept()
+                for sock in (client_sock, server_sock):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                server, client = messaging.ConnectionManager(), client_factory()
+                self.server_loop.register(server, server_sock)
+                self.client_loop.register(client, client_sock)
+                self.servers.append(server)
+                self.clients.append(client)
+        self.server_loop.start()
+        self.client_loop.start()
+
+    def close(self):
+        self.server_loop.stop()
+        self.client_loop.stop()
+        for connection in self.servers + self.clients:
+            connection.socket.close()
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    samples = sorted(samples)
+    result = collections.OrderedDict([("min", samples[0])])
+    for point in points:
+        result["p{}".format(point)] = samples[min(len(samples) - 1, int(len(samples) * point / 100.0))]
+    result["max"] = samples[-1]
+    result["mean"] = sum(samples) / len(samples)
+    return collections.OrderedDict((key, round(value * 1000, 3)) for key, value in result.items())
+
+
+def bench_rtt(iterations):
+    messaging.ConnectionManager.requests_callbacks["benchmark_echo"] = lambda connection, value=None: value
+    loopback = Loopback(1)
+    try:
+        server = loopback.servers[0]
+        samples = []
+        for _ in range(iterations):
+            answered = threading.Event()
+            started = time.time()
+            server.get_response("benchmark_echo", lambda connection, value: answered.set(),
+                                request_kwargs={"value": TELEMETRY_SAMPLE}, timeout=5)
+            if not answered.wait(5):
+                raise RuntimeError("No response to benchmark request")
+            samples.append(time.time() - started)
+    finally:
+        loopback.close()
+        messaging.ConnectionManager.requests_callbacks.pop("benchmark_echo")
+    return collections.OrderedDict([("requests", iterations), ("rtt_ms", percentiles(samples))])
+
+
+def bench_broadcast(clients_counts, iterations):
+    results = collections.OrderedDict()
+    for clients_count in clients_counts:
+        counter = EventCounter(0)
+        loopback = Loopback(clients_count, lambda: CountingConnection(counter))
+        try:
+            samples = []
+            for _ in range(iterations):
+                counter.done.clear()
+                counter.target = counter.count + clients_count
+                started = time.time()
+                # message is created once and queued to every client, as Client.broadcast_message does
+                message = messaging.MessageManager.create_action_message("benchmark", kwargs=TELEMETRY_SAMPLE)
+                for server in loopback.servers:
+                    server._send(message)
+                if not counter.done.wait(10):
+                    raise RuntimeError("Broadcast was not delivered to all clients")
+                samples.append(time.time() - started)
+        finally:
+            loopback.close()
+        results[clients_count] = collections.OrderedDict([("broadcasts", iterations),
+                                                          ("fan_out_ms", percentiles(samples))])
+    return results
+
+
+def bench_files(file_sizes):
+    results = collections.OrderedDict()
+    directory = tempfile.mkdtemp()
+    loopback = Loopback(1)
+    try:
+        server = loopback.servers[0]
+        for file_size in file_sizes:
+            source = os.path.join(directory, "source_{}.bin".format(file_size))
+            destination = os.path.join(directory, "destination_{}.bin".format(file_size))
+            with open(source, 'wb') as f:
+                f.write(os.urandom(file_size))
+
+            started = time.time()
+            server.send_file(source, destination)
+            while not os.path.exists(destination):
+                time.sleep(0.001)
+            elapsed = time.time() - started
+            results[file_size] = collections.OrderedDict([
+                ("seconds", round(elapsed, 4)),
+                ("mb_s", round(file_size / elapsed / 2 ** 20, 2)),
+            ])
+            os.remove(source)
+            os.remove(destination)
+    finally:
+        loopback.close()
+        shutil.rmtree(directory)
+    return results
+
+
+BENCHMARKS = ('parsing', 'fragmented', 'headers', 'rtt', 'broadcast', 'files')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark message framing")
+    parser.add_argument('benchmark', nargs='*', choices=BENCHMARKS + ('all',), default='all',
+                        help="parsing: legacy vs current receive path; fragmented: receive path with random "
+                             "fragmentation; headers: JSON vs binary header; rtt: get_response round trip; "
+                             "broadcast: fan-out to clients; files: file transfer speed")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 64 * 1024, 8 * 1024 * 1024],
+                        help="payload sizes in bytes")
+    parser.add_argument('--buffer-size', type=int, default=1024, help="bytes returned by a single recv call")
+    parser.add_argument('--total', type=int, default=8 * 1024 * 1024, help="amount of data to parse for each size")
+    parser.add_argument('--iterations', type=int, default=20000, help="messages to create and parse for headers")
+    parser.add_argument('--requests', type=int, default=1000, help="requests to send for rtt")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50], help="client counts for broadcast")
+    parser.add_argument('--broadcasts', type=int, default=200, help="broadcasts to send for each client count")
+    parser.add_argument('--file-sizes', type=int, nargs='+', default=[1024 * 1024, 32 * 1024 * 1024],
+                        help="file sizes in bytes for files")
+    parser.add_argument('--output', help="also write JSON results to this file")
+    args = parser.parse_args()
+
+    # default is a plain string, as list default is checked against choices as a whole
+    benchmarks = [args.benchmark] if isinstance(args.benchmark, str) else args.benchmark
+    selected = BENCHMARKS if 'all' in benchmarks else benchmarks
+    results = collections.OrderedDict()
+    if 'parsing' in selected:
+        results['parsing'] = bench_parsing(args.sizes, args.buffer_size, args.total)
+    if 'fragmented' in selected:
+        results['fragmented'] = bench_fragmented(args.sizes, args.buffer_size, args.total)
+    if 'headers' in selected:
+        results['headers'] = bench_headers(args.iterations)
+    if 'rtt' in selected:
+        results['rtt'] = bench_rtt(args.requests)
+    if 'broadcast' in selected:
+        results['broadcast'] = bench_broadcast(args.clients, args.broadcasts)
+    if 'files' in selected:
+        results['files'] = bench_files(args.file_sizes)
+
+    output = json.dumps(results, indent=4)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)